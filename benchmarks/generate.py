@@ -0,0 +1,176 @@
+#!/usr/bin/env python
+""" Deterministic synthetic inputs for BlasTreeDom benchmarks: \
+    genBank files, query protein sets and ProSite-like pattern files """
+import argparse
+import os
+import random
+
+from Bio import SeqIO
+from Bio.Seq import Seq
+from Bio.SeqFeature import FeatureLocation, SeqFeature
+from Bio.SeqRecord import SeqRecord
+
+AMINOACIDS = 'ACDEFGHIKLMNPQRSTVWY'
+# Dataset sizes: genBank files, records per file, CDS per record,
+# queries and ProSite patterns
+SIZES = {
+         'small': dict(genbanks=2, records=2, cds=100, queries=8,
+                       patterns=200),
+         'medium': dict(genbanks=4, records=4, cds=250, queries=24,
+                        patterns=600),
+         'large': dict(genbanks=8, records=8, cds=500, queries=64,
+                       patterns=1300)
+        }
+
+
+def random_protein(rng, min_length=80, max_length=400):
+    """ Random protein sequence (starting with methionine) """
+    length = rng.randint(min_length, max_length)
+    return 'M'+''.join(rng.choice(AMINOACIDS) for dummy in range(length-1))
+
+
+def mutate(rng, sequence, rate):
+    """ Substitute given fraction of residues of sequence at random """
+    residues = list(sequence)
+    for idx in rng.sample(range(1, len(residues)), int(rate*len(residues))):
+        residues[idx] = rng.choice(AMINOACIDS)
+    return ''.join(residues)
+
+
+def write_genbanks(output_dir, genbanks, records, cds, seed=0):
+    """ Write genBank files with given number of records and CDS each.
+        About 10% of CDS repeat an earlier protein (same protein_id and \
+        translation, as shared RefSeq proteins) and 5% lack translation.
+        Most proteins belong to families (5-35% residues substituted \
+        from a family ancestor), so that queries have many hits.
+        Return list of genBank files and {protein_id: translation} """
+    rng = random.Random(seed)
+    os.makedirs(output_dir, exist_ok=True)
+    proteins = {}
+    ancestors = []
+    filenames = []
+    for file_idx in range(genbanks):
+        gb_records = []
+        for record_idx in range(records):
+            name = 'SYN{:02d}{:03d}'.format(file_idx, record_idx)
+            dna = ''.join(rng.choice('ACGT') for dummy in range(cds*120))
+            record = SeqRecord(Seq(dna), id=name+'.1', name=name,
+                               description='synthetic genome '+name,
+                               annotations={'molecule_type': 'DNA'})
+            for cds_idx in range(cds):
+                if proteins and rng.random() < 0.1:
+                    protein_id = rng.choice(sorted(proteins))
+                else:
+                    protein_id = 'WP_{:09d}.1'.format(len(proteins))
+                    if ancestors and rng.random() < 0.95:
+                        proteins[protein_id] = mutate(rng,
+                                                      rng.choice(ancestors),
+                                                      rng.uniform(0.05, 0.35))
+                    else:
+                        ancestors.append(random_protein(rng))
+                        proteins[protein_id] = ancestors[-1]
+                qualifiers = {'locus_tag': ['{}_{:05d}'.format(name, cds_idx)],
+                              'protein_id': [protein_id],
+                              'product': ['hypothetical protein {}'
+                                          .format(cds_idx)],
+                              'db_xref': ['GeneID:{}'.format(cds_idx)]}
+                if rng.random() < 0.5:
+                    qualifiers['gene'] = ['syn{}'.format(cds_idx)]
+                if rng.random() < 0.3:
+                    qualifiers['EC_number'] = ['3.1.1.{}'.format(cds_idx)]
+                if rng.random() < 0.95:
+                    qualifiers['translation'] = [proteins[protein_id]]
+                start = cds_idx*120
+                record.features.append(SeqFeature(
+                                 FeatureLocation(start, start+90,
+                                                 strand=rng.choice([1, -1])),
+                                 type='CDS', qualifiers=qualifiers))
+            gb_records.append(record)
+        filename = output_dir.rstrip('/')+'/synthetic_{:02d}.gbff'\
+                                          .format(file_idx)
+        SeqIO.write(gb_records, filename, 'genbank')
+        filenames.append(filename)
+    return filenames, proteins
+
+
+def write_queries(output_filename, proteins, n_queries, seed=0):
+    """ Write queries derived from subject proteins \
+        (10-40% residues substituted), so that every query has hits """
+    rng = random.Random(seed)
+    with open(output_filename, 'w') as fasta:
+        for idx, protein_id in enumerate(rng.sample(sorted(proteins),
+                                                    n_queries)):
+            sequence = mutate(rng, proteins[protein_id],
+                              rng.uniform(0.1, 0.4))
+            fasta.write('>QUERY{:04d} derived from {}\n{}\n'
+                        .format(idx, protein_id, sequence))
+    return
+
+
+def _pattern_element(rng):
+    """ Random ProSite pattern element (residue, class, exclusion \
+        or wildcard, optionally repeated) """
+    draw = rng.random()
+    if draw < 0.4: element = rng.choice(AMINOACIDS)
+    elif draw < 0.75:
+        element = '['+''.join(rng.sample(AMINOACIDS, rng.randint(2, 4)))+']'
+    elif draw < 0.85:
+        element = '{'+''.join(rng.sample(AMINOACIDS, rng.randint(1, 3)))+'}'
+    else: element = 'x'
+    draw = rng.random()
+    if draw < 0.1: element += '({})'.format(rng.randint(2, 3))
+    elif draw < 0.15 and element == 'x':
+        low = rng.randint(0, 2)
+        element += '({},{})'.format(low, low+rng.randint(1, 4))
+    return element
+
+
+def write_prosite(output_dir, n_patterns, seed=0):
+    """ Write ProSite-like prosite.dat and prosite.doc \
+        with given number of patterns of 6-14 elements """
+    rng = random.Random(seed)
+    os.makedirs(output_dir, exist_ok=True)
+    with open(output_dir.rstrip('/')+'/prosite.dat', 'w') as dat,\
+         open(output_dir.rstrip('/')+'/prosite.doc', 'w') as doc:
+        dat.write('CC   Release 0000_00 of synthetic benchmark data.\n//\n')
+        for idx in range(n_patterns):
+            elements = [_pattern_element(rng)
+                        for dummy in range(rng.randint(6, 14))]
+            if rng.random() < 0.05: elements[0] = '<'+elements[0]
+            dat.write('ID   SYNTHETIC_{0:04d}; PATTERN.\n'
+                      'AC   PS{0:05d};\n'
+                      'DE   Synthetic pattern {0}.\n'
+                      'PA   {1}.\n'
+                      'DO   PDOC{0:05d};\n'
+                      '//\n'.format(idx, '-'.join(elements)))
+            doc.write('{{PDOC{0:05d}}}\n'
+                      '{{PS{0:05d}; SYNTHETIC_{0:04d}}}\n'
+                      '{{BEGIN}}\n'
+                      'Synthetic pattern {0} documentation.\n'
+                      '{{END}}\n'.format(idx))
+    return
+
+
+def generate(output_dir, size='small', seed=0):
+    """ Generate complete dataset of given size in output_dir: \
+        genBanks/, queries.fasta and prosite_files/ """
+    sizes = SIZES[size]
+    dummy_files, proteins = write_genbanks(
+                                output_dir.rstrip('/')+'/genBanks',
+                                sizes['genbanks'], sizes['records'],
+                                sizes['cds'], seed=seed)
+    write_queries(output_dir.rstrip('/')+'/queries.fasta', proteins,
+                  sizes['queries'], seed=seed)
+    write_prosite(output_dir.rstrip('/')+'/prosite_files',
+                  sizes['patterns'], seed=seed)
+    return
+
+
+if __name__ == '__main__':
+    arg_parser = argparse.ArgumentParser(
+                 description='Generate synthetic benchmark dataset')
+    arg_parser.add_argument('output_dir', type=str)
+    arg_parser.add_argument('-size', choices=sorted(SIZES), default='small')
+    arg_parser.add_argument('-seed', type=int, default=0)
+    args = arg_parser.parse_args()
+    generate(args.output_dir, args.size, args.seed)
@@ -0,0 +1,261 @@
+#!/usr/bin/env python
+""" Time the python hot paths of BlasTreeDom on synthetic data \
+    (see generate.py), using deterministic stand-ins for blastp, \
+    makeblastdb and muscle (see bin/), and compare against \
+    stored baseline """
+import argparse
+import json
+import os
+import platform
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+from Bio.SeqIO.FastaIO import SimpleFastaParser
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.dirname(BENCH_DIR))
+
+import blast as bl
+import file_handler as fh
+import genbank_parser as gbp
+import graphication as graph
+import metrics
+import muscle as ms
+import prosite_parser as proparse
+
+import generate as gen
+
+BASELINE = BENCH_DIR+'/baseline.json'
+MAIN = os.path.dirname(BENCH_DIR)+'/main.py'
+# Command line help must return within given time (s)
+# without importing any of the heavy modules
+MAX_STARTUP = 0.2
+HEAVY_MODULES = ['pandas', 'numpy', 'pyarrow', 'Bio', 'matplotlib', 'seaborn']
+
+
+def time_startup(repeat=5):
+    """ Return best wall time (s) of `python main.py --help` \
+        and heavy modules (see HEAVY_MODULES) imported by it """
+    best = None
+    for dummy in range(repeat):
+        time0 = time.perf_counter()
+        subprocess.run([sys.executable, MAIN, '--help'],
+                       stdout=subprocess.DEVNULL, check=True)
+        wall = time.perf_counter() - time0
+        best = wall if best is None else min(best, wall)
+    # Modules loaded by help, listed (to stderr) by the same interpreter
+    code = ('import runpy, sys\n'
+            'sys.argv = [{0!r}, "--help"]\n'
+            'try: runpy.run_path({0!r}, run_name="__main__")\n'
+            'except SystemExit: pass\n'
+            'sys.stderr.write(" ".join(sys.modules))').format(MAIN)
+    modules = subprocess.run([sys.executable, '-c', code],
+                             stdout=subprocess.DEVNULL, stderr=subprocess.PIPE,
+                             universal_newlines=True, check=True)\
+                        .stderr.split()
+    return round(best, 3), [module for module in HEAVY_MODULES
+                            if module in modules]
+
+
+def run_suite(data_dir, work_dir, workers=1, max_figures=5):
+    """ Run every benchmarked step on dataset in data_dir, \
+        storing outputs in work_dir. Return measured steps \
+        (see metrics.measure) """
+    work_dir = work_dir.rstrip('/')+'/'
+    proparse.PROSITE_DAT = data_dir.rstrip('/')+'/prosite_files/prosite.dat'
+    proparse.PROSITE_DOC = data_dir.rstrip('/')+'/prosite_files/prosite.doc'
+    queries = data_dir.rstrip('/')+'/queries.fasta'
+    subjects = work_dir+'genBank_multifasta.fasta'
+    blast_output = work_dir+'_blastp'
+    metrics.start(work_dir)
+    fh.fasta2dirs(fasta_file=queries, output_dir=work_dir)
+    with metrics.measure('gb_parser') as counts:
+        counts['files'], counts['cds'] = gbp.parse_gbs(
+                                  genBanks=[data_dir.rstrip('/')+'/genBanks'],
+                                  sequence_type='prot',
+                                  output_dir=work_dir,
+                                  output_filename=subjects,
+                                  workers=workers
+                                  )
+    # Database built from deduplicated subjects, hits expanded back
+    dedup_fasta = work_dir+'_dedup.fasta'
+    members_filename = work_dir+'_dedup_members.json'
+    with metrics.measure('dedup') as counts:
+        counts['sequences'], counts['representatives'],\
+        counts['residues'] = bl.dedup_multifasta(
+                                  multifasta=subjects,
+                                  output_filename=dedup_fasta,
+                                  members_filename=members_filename
+                                  )
+    with metrics.measure('makeblastdb'):
+        bl.multifasta2database(multifasta=dedup_fasta, sequence_type='prot',
+                               output_dir=work_dir,
+                               output_filename='genBank')
+    members, dbsize = bl.read_members(members_filename)
+    with metrics.measure('blast_compute') as counts:
+        counts['hits_read'], counts['hits'] = bl.blast_compute(
+                                  query_fasta=queries,
+                                  database_path=work_dir+'database/genBank',
+                                  sequence_type='prot',
+                                  e_value='1e-03',
+                                  output_dir=work_dir,
+                                  output_filename=blast_output,
+                                  members=members,
+                                  dbsize=dbsize
+                                  )
+    with metrics.measure('retrieve_seqs') as counts:
+        hits = bl.retrieve_seqs(
+                                  query_fasta=queries,
+                                  subject_multifasta=subjects,
+                                  blast_output=blast_output+'.tsv',
+                                  output_dir=work_dir
+                                  )
+        counts['subjects'] = hits.sseqid.nunique()
+    # Hit tables as read back by a resumed run
+    with metrics.measure('read_hits') as counts:
+        counts['hits'] = len(fh.read_hits(work_dir))
+    with metrics.measure('tsv2fasta'):
+        fh.tsv2fasta(tsv_file=hits, output_dir=work_dir,
+                     separate_dirs=True, include_query=True)
+    with metrics.measure('alignment') as counts:
+        counts['queries'], dummy_alignment, dummy_tree = \
+            ms.align_and_build_trees(blast_output=hits,
+                                     output_dir=work_dir, jobs=workers,
+                                     backend='numpy')
+    # Every distinct subject sequence scanned once (no domain cache)
+    with open(subjects, 'r') as fasta:
+        sequences = sorted(set(sequence for dummy_title, sequence
+                               in SimpleFastaParser(fasta)))
+    scanner = proparse.load_scanner()
+    with metrics.measure('dat_parser') as counts:
+        counts['sequences'] = len(sequences)
+        counts['domains'] = sum(len(proparse.dat_parser(sequence,
+                                                        scanner=scanner))
+                                for sequence in sequences)
+    with metrics.measure('find_domains') as counts:
+        counts['queries'], counts['sequences'] = proparse.find_domains(
+                                  blast_output=hits,
+                                  output_dir=work_dir,
+                                  workers=workers,
+                                  use_cache=False
+                                  )
+    with metrics.measure('merge_results') as counts:
+        counts['rows'] = fh.merge_results(
+                                  blast_output=hits,
+                                  genBank_info=work_dir
+                                               +'_genBank_info.feather',
+                                  output_dir=work_dir,
+                                  output_filename='_merged.tsv',
+                                  include_gb=True
+                                  )
+    with metrics.measure('graphs') as counts:
+        counts['blast_figures'], dummy_unchanged = graph.blast_plot(
+                                  blast_output=hits,
+                                  output_dir=work_dir,
+                                  workers=workers
+                                  )
+        counts['domain_figures'], dummy_unchanged = graph.domain_plot(
+                                  blast_output=hits,
+                                  output_dir=work_dir,
+                                  workers=workers,
+                                  max_figures=max_figures
+                                  )
+    return metrics.steps()
+
+
+def compare(baseline, current, threshold):
+    """ Print table of step wall times against baseline ones. \
+        Return steps slower than baseline by more than threshold (%) """
+    regressions = []
+    print('\n{:<16}{:>14}{:>14}{:>10}'.format('step', 'baseline (s)',
+                                              'current (s)', 'change'))
+    for step, wall in current.items():
+        if step in baseline and baseline[step] > 0:
+            change = 100 * (wall - baseline[step]) / baseline[step]
+            print('{:<16}{:>14.3f}{:>14.3f}{:>9.1f}%'.format(
+                  step, baseline[step], wall, change))
+            if threshold is not None and change > threshold:
+                regressions.append(step)
+        else:
+            print('{:<16}{:>14}{:>14.3f}{:>10}'.format(step, '-', wall, '-'))
+    return regressions
+
+
+def main():
+    arg_parser = argparse.ArgumentParser(
+                 description='Benchmark BlasTreeDom hot paths on synthetic \
+                              data and compare against stored baseline')
+    arg_parser.add_argument('-size', choices=sorted(gen.SIZES),
+                            default='small', help='Dataset size. \
+                                                   Default: small')
+    arg_parser.add_argument('-seed', type=int, default=0,
+                            help='Dataset random seed. Default: 0')
+    arg_parser.add_argument('-repeat', type=int, default=3,
+                            help='Runs of the suite (best wall time \
+                                  of each step is kept). Default: 3')
+    arg_parser.add_argument('-workers', type=int, default=1,
+                            help='Worker processes. Default: 1')
+    arg_parser.add_argument('-save_baseline', action='store_true',
+                            help='Store results as baseline of dataset size')
+    arg_parser.add_argument('-max_regression', type=float,
+                            help='Exit with error if any step is slower \
+                                  than baseline by more than given %%')
+    arg_parser.add_argument('-keep', type=str,
+                            help='Keep data and outputs in given directory')
+    arg_parser.add_argument('-max_startup', type=float, default=MAX_STARTUP,
+                            help='Exit with error if command line help \
+                                  takes longer (s) or imports heavy \
+                                  modules. Default: {}'.format(MAX_STARTUP))
+    args = arg_parser.parse_args()
+
+    startup, heavy = time_startup()
+    print('Command line help: {:.3f}s'.format(startup))
+
+    # Stand-ins first in PATH
+    os.environ['PATH'] = BENCH_DIR+'/bin'+os.pathsep+os.environ['PATH']
+    root = args.keep or tempfile.mkdtemp(prefix='BlasTreeDom_bench_')
+    data_dir = root.rstrip('/')+'/data'
+    print('Generating {} dataset...'.format(args.size))
+    gen.generate(data_dir, args.size, args.seed)
+    best = {'cli_help': startup}
+    for run in range(args.repeat):
+        print('Run {} of {}...'.format(run+1, args.repeat))
+        work_dir = root.rstrip('/')+'/run{}'.format(run)
+        if os.path.isdir(work_dir): shutil.rmtree(work_dir)
+        os.makedirs(work_dir)
+        for step in run_suite(data_dir, work_dir, workers=args.workers):
+            best[step['step']] = min(best.get(step['step'], step['wall_s']),
+                                     step['wall_s'])
+    if not args.keep: shutil.rmtree(root)
+
+    baselines = {}
+    if os.path.exists(BASELINE):
+        with open(BASELINE, 'r') as baseline_file:
+            baselines = json.load(baseline_file)
+    baseline = baselines.get(args.size, {}).get('steps', {})
+    regressions = compare(baseline, best, args.max_regression)
+    if args.save_baseline:
+        baselines[args.size] = dict(python=platform.python_version(),
+                                    machine=platform.machine(),
+                                    seed=args.seed, workers=args.workers,
+                                    steps=best)
+        with open(BASELINE, 'w') as baseline_file:
+            json.dump(baselines, baseline_file, indent=1, sort_keys=True)
+        print('\nBaseline stored in '+BASELINE)
+    failed = bool(regressions)
+    if regressions:
+        print('\nSlower than baseline: '+', '.join(regressions))
+    if startup > args.max_startup:
+        print('\nCommand line help slower than {}s'.format(args.max_startup))
+        failed = True
+    if heavy:
+        print('\nCommand line help imports: '+', '.join(heavy))
+        failed = True
+    if failed: sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
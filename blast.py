@@ -1,14 +1,26 @@
 #!/usr/bin/env python
 
 import argparse
+import fcntl
+import hashlib
+import heapq
+import itertools
+import json
 import os
+import queue
+import shutil
 import sys
+import threading
 
-import numpy as np
-import pandas as pd
 from subprocess import call, PIPE, Popen
 
-import file_handler as fh
+# pandas, Bio and file_handler are imported by the functions using them,
+# so that importing this module (e.g. for command line help) is fast
+
+# Default directory of content-addressed BLAST database cache
+DB_CACHE = os.path.expanduser('~/.cache/BlasTreeDom/databases')
+# Locks on cached databases used by this process (held until exit)
+_DB_LOCKS = []
 
 
 def multifasta2database(multifasta, sequence_type, output_dir,
@@ -27,8 +39,166 @@ def multifasta2database(multifasta, sequence_type, output_dir,
     return
 
 
+def dedup_multifasta(multifasta, output_filename, members_filename):
+    """ Write first sequence (representative) of every set \
+        of identical sequences in multifasta into output_filename, \
+        in original order. Ids of the other sequences (members) \
+        are stored as JSON {representative id: [member ids]} \
+        in members_filename, only for representatives with members, \
+        with total residue count of multifasta (blast -dbsize, so that \
+        e-values are those of a search against every sequence).
+        Return number of sequences, of representatives and of residues """
+    from Bio.SeqIO.FastaIO import SimpleFastaParser
+    # Sequences are kept as digests: memory does not depend on their length
+    representatives = {}
+    members = {}
+    n_sequences = 0
+    n_residues = 0
+    with open(multifasta, 'r') as fasta,\
+         open(output_filename, 'w', buffering=1 << 20) as output_file:
+        for title, sequence in SimpleFastaParser(fasta):
+            n_sequences += 1
+            n_residues += len(sequence)
+            seqid = title.split(None, 1)[0]
+            key = hashlib.blake2b(sequence.encode(), digest_size=16).digest()
+            if key in representatives:
+                members.setdefault(representatives[key], []).append(seqid)
+            else:
+                representatives[key] = seqid
+                output_file.write('>'+title+'\n'+sequence+'\n')
+    with open(members_filename, 'w') as members_file:
+        json.dump({'dbsize': n_residues, 'members': members}, members_file,
+                  separators=(',', ':'))
+    return n_sequences, len(representatives), n_residues
+
+
+def read_members(members_filename):
+    """ Return {representative id: [member ids]} and database size \
+        stored by dedup_multifasta """
+    with open(members_filename, 'r') as members_file:
+        stored = json.load(members_file)
+    return stored['members'], stored['dbsize']
+
+
+def expand_hits(lines, members, outfmt):
+    """ Yield blast tabular output lines, each one followed \
+        by a copy for every member of its subject (see dedup_multifasta) """
+    idx = outfmt.split()[1:].index('sseqid')
+    for line in lines:
+        yield line
+        # sseqid may be the last field (followed by newline)
+        values = line.rstrip('\n').split('\t')
+        for member in members.get(values[idx], ()):
+            values[idx] = member
+            yield '\t'.join(values)+'\n'
+
+
+def _database_key(multifasta, sequence_type):
+    """ Return sha256 hex digest of multifasta content and dbtype """
+    import file_handler as fh
+    return fh.file_hash(multifasta, salt=sequence_type.encode()+b'\0')
+
+
+def _dir_size(directory):
+    """ Return total size in bytes of files in directory """
+    return sum(os.path.getsize(directory+'/'+file)
+               for file in os.listdir(directory))
+
+
+def _lock_shared(lock_file):
+    """ Return lock_file opened and locked shared. \
+        A lock file removed (see _evict_databases) while waiting \
+        for it is opened again """
+    while True:
+        handle = open(lock_file, 'w')
+        fcntl.flock(handle, fcntl.LOCK_SH)
+        try:
+            if os.stat(lock_file).st_ino == os.fstat(handle.fileno()).st_ino:
+                return handle
+        except FileNotFoundError:
+            pass
+        handle.close()
+
+
+def _evict_databases(cache_dir, max_size):
+    """ Remove least recently used databases in cache_dir \
+        (and their lock files) until it takes at most max_size bytes. \
+        Databases in use by any run (whose use lock cannot be \
+        taken exclusively) are kept """
+    with open(cache_dir+'.lock', 'w') as cache_lock:
+        fcntl.flock(cache_lock, fcntl.LOCK_EX)
+        entries = [cache_dir+entry for entry in os.listdir(cache_dir)
+                   if os.path.isdir(cache_dir+entry)
+                   and not entry.endswith('.tmp')]
+        sizes = {entry: _dir_size(entry) for entry in entries}
+        total = sum(sizes.values())
+        for entry in sorted(entries, key=os.path.getmtime):
+            if total <= max_size: break
+            with open(entry+'.lock', 'w') as entry_lock:
+                try:
+                    fcntl.flock(entry_lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                except BlockingIOError:
+                    continue
+                shutil.rmtree(entry)
+                # Removed while still locked: runs waiting on them
+                # lock them again (see _lock_shared)
+                if os.path.exists(entry+'.build.lock'):
+                    os.remove(entry+'.build.lock')
+                os.remove(entry+'.lock')
+                total -= sizes[entry]
+
+
+def cached_database(multifasta, sequence_type, cache_dir=DB_CACHE,
+                    max_size=None, log='/dev/null'):
+    """ Return path to BLAST database of multifasta, \
+        reusing it from cache_dir (keyed by content and dbtype) \
+        or creating it there with makeblastdb.
+        Runs using an already cached database do not wait for each \
+        other; concurrent runs missing the same database wait for \
+        the one building it instead of building it twice. \
+        If max_size (bytes) is given, least recently used databases \
+        not in use are evicted """
+    cache_dir = cache_dir.rstrip('/')+'/'
+    os.makedirs(cache_dir, exist_ok=True)
+    entry = cache_dir+_database_key(multifasta, sequence_type)
+    # Shared use lock, held until exit: keeps database from eviction
+    entry_lock = _lock_shared(entry+'.lock')
+    _DB_LOCKS.append(entry_lock)
+    if os.path.isdir(entry):
+        print("Using cached database "+entry)
+    else:
+        with open(entry+'.build.lock', 'w') as build_lock:
+            fcntl.flock(build_lock, fcntl.LOCK_EX)
+            # Built by another run while waiting
+            if os.path.isdir(entry):
+                print("Using cached database "+entry)
+            else:
+                tmp_entry = entry+'.tmp'
+                if os.path.isdir(tmp_entry): shutil.rmtree(tmp_entry)
+                os.mkdir(tmp_entry)
+                with open(log, 'a+') as log_file:
+                    returncode = call(
+                                      ['makeblastdb', '-in', multifasta,
+                                       '-dbtype', sequence_type,
+                                       '-out', tmp_entry+'/database'],
+                                      stdout=log_file,
+                                      stderr=log_file
+                                     )
+                if returncode != 0:
+                    shutil.rmtree(tmp_entry)
+                    _DB_LOCKS.remove(entry_lock)
+                    entry_lock.close()
+                    raise RuntimeError('makeblastdb failed, see '+log)
+                os.rename(tmp_entry, entry)
+    # Mark as recently used
+    os.utime(entry)
+    if max_size is not None: _evict_databases(cache_dir, max_size)
+    return entry+'/database'
+
+
 def save_multifasta(input_file = "blast_output.tsv",
                     output_filename = "blast_output.fasta"):
+    import pandas as pd
     blast_output = pd.read_csv(input_file, delimiter='\t')
     output_file = open(output_filename, 'w')
     for dummy_idx, hit in blast_output.iterrows():
@@ -38,76 +208,264 @@ def save_multifasta(input_file = "blast_output.tsv",
     return
 
 
+def split_fasta(fasta_file, n_shards, output_prefix):
+    """ Split FASTA file into (at most) n_shards FASTA files \
+        output_prefix.<shard>.fasta balanced by residue count. \
+        Records keep their original order inside each shard.
+        Return shard filenames and {sequence id: original position} """
+    from Bio.SeqIO.FastaIO import SimpleFastaParser
+    with open(fasta_file, 'r') as fasta:
+        records = list(SimpleFastaParser(fasta))
+    n_shards = max(1, min(n_shards, len(records)))
+    loads = [0 for dummy in range(n_shards)]
+    shards = [ [] for dummy in range(n_shards) ]
+    # Largest records first, each one to the least loaded shard
+    for idx in sorted(range(len(records)),
+                      key=lambda idx: -len(records[idx][1])):
+        shard = loads.index(min(loads))
+        shards[shard].append(idx)
+        loads[shard] += len(records[idx][1])
+    filenames = []
+    for shard, indices in enumerate(shards):
+        filename = '{}.{}.fasta'.format(output_prefix, shard)
+        with open(filename, 'w') as shard_file:
+            for idx in sorted(indices):
+                shard_file.write('>'+records[idx][0]+'\n'
+                                 +records[idx][1]+'\n')
+        filenames.append(filename)
+    order = {}
+    for idx, (title, dummy_seq) in enumerate(records):
+        order.setdefault(title.split(None, 1)[0], idx)
+    return filenames, order
+
+
+def _blast_command(sequence_type, query_fasta, database_path, e_value,
+                   outfmt, threads=1, output=None, dbsize=None):
+    """ blastp or blastn command for protein or nucleotide sequences \
+        respectively. Output to stdout if no output file given. \
+        E-values computed for dbsize residues if given """
+    command = ['blastp' if sequence_type == 'prot' else 'blastn',
+               '-query', query_fasta, '-db', database_path,
+               '-evalue', str(e_value), '-outfmt', outfmt,
+               '-num_threads', str(threads)]
+    if output: command.extend(['-out', output])
+    if dbsize: command.extend(['-dbsize', str(dbsize)])
+    return command
+
+
 def blast_compute(query_fasta, database_path, sequence_type, e_value,
                   cov_threshold=0,  pident_threshold=0,
                   outfmt='6 qseqid sseqid qcovs qstart qend pident evalue',
                   output_dir=None,
-                  output_filename='blast_output', log='/dev/null'):
+                  output_filename='blast_output', log='/dev/null',
+                  shards=1, threads=1, members=None, dbsize=None):
     """ Perform blastp or blastn analysis for protein \
         or nucleotide sequences respectively.
+        Queries can be split in shards (balanced by residue count) \
+        searched by concurrent processes using given threads each.
+        Hits of deduplicated subjects are expanded to every member \
+        (see dedup_multifasta) if members are given, e-values being \
+        computed for dbsize residues (size of the whole subject set).
         Output filtered by query coverage, identity percentage \
         and e-value thresholds """
-    if sequence_type == "prot":
-        blast_type = 'blastp'
-    elif sequence_type == "nucl":
-        blast_type = 'blastn'
     output = output_dir.rstrip('/')+'/'+os.path.basename(output_filename)
 
-    call(
-         [blast_type, '-query', query_fasta, '-db', database_path,
-         '-evalue', str(e_value), '-out', output+'.tsv', '-outfmt', outfmt],
-         stderr=open(log, 'a+')
-        )
-    # Include headers in output .tsv file
-    first_line = outfmt[2:].replace(" ", "\t")
-    blast = open(output+'.tsv', 'r')
-    blast_output = blast.read()
-    blast.close()
-    output_file = open(output+'.tsv', 'w')
-    output_file.write(first_line + '\n')
-    output_file.write(blast_output)
-    output_file.close()
-    # Filter output by coverage and identity percentage thresholds
     if pident_threshold == None: pident_threshold = 0.0
     if cov_threshold == None: cov_threshold = 0.0
-    df = pd.read_csv(output+'.tsv', delimiter='\t')
-    filtered_output = df.loc[(df.pident >= pident_threshold)
-                              & (df.qcovs >= cov_threshold)]
-    filtered_output.to_csv(output+'.tsv', sep='\t', index=False)
+    if shards <= 1:
+        shard_fastas = []
+        raw_outputs = [output+'.raw.tsv']
+        with open(log, 'a+') as log_file:
+            returncodes = [call(
+                                _blast_command(sequence_type, query_fasta,
+                                               database_path, e_value, outfmt,
+                                               threads, raw_outputs[0],
+                                               dbsize),
+                                stderr=log_file
+                               )]
+    else:
+        shard_fastas, order = split_fasta(query_fasta, shards, output+'.shard')
+        raw_outputs = [shard.rsplit('.', 1)[0]+'.tsv' for shard in shard_fastas]
+        with open(log, 'a+') as log_file:
+            processes = [Popen(
+                               _blast_command(sequence_type, shard,
+                                              database_path, e_value, outfmt,
+                                              threads, shard_output, dbsize),
+                               stderr=log_file
+                              ) for shard, shard_output
+                         in zip(shard_fastas, raw_outputs)]
+            returncodes = [process.wait() for process in processes]
+    for filename in shard_fastas: os.remove(filename)
+    if any(returncodes):
+        # Partial output of failed search is not kept
+        for raw_output in raw_outputs:
+            if os.path.exists(raw_output): os.remove(raw_output)
+        raise RuntimeError('blastp failed, see '+log)
+    raw_files = [open(raw_output, 'r') for raw_output in raw_outputs]
+    if shards <= 1: lines = raw_files[0]
+    else:
+        # Merge shard outputs back into original query order
+        # (ids not found in query FASTA titles go last)
+        lines = heapq.merge(*raw_files,
+                            key=lambda line: order.get(line.split('\t', 1)[0],
+                                                       len(order)))
+    if members: lines = expand_hits(lines, members, outfmt)
+    with open(output+'.tsv', 'w', buffering=1 << 20) as output_file:
+        n_read, n_kept = filter_blast_output(lines, output_file, outfmt,
+                                             pident_threshold, cov_threshold)
+    for raw_file in raw_files: raw_file.close()
+    for raw_output in raw_outputs: os.remove(raw_output)
+    print('{} blast hits read, {} kept after filtering'.format(n_read, n_kept))
+    return n_read, n_kept
 
 
-def retrieve_seqs(query_fasta, subject_multifasta, blast_output, output_dir,
-                  output_filename, remove_files=False):
-    """ Generate multifasta file with complete hit subject sequences \
-        for each query in blast_output file """
-    if not os.path.isdir(output_dir): os.mkdir(output_dir)
-    subject_tsv = os.path.basename(subject_multifasta).rsplit('.', 1)[0]+'.tsv'
-    query_tsv = os.path.basename(query_fasta).rsplit('.', 1)[0]+'.tsv'
-    fh.fasta2tsv(
-                 fasta_file=query_fasta,
-                 output_dir=output_dir,
-                 output_filename=query_tsv,
-                 fields=['qseqid', 'qseq', 'qseqlen'],
-                 seq_length=True
-                )
-    fh.fasta2tsv(
-                 fasta_file=subject_multifasta,
-                 output_dir=output_dir,
-                 output_filename=subject_tsv,
-                 fields=['sseqid', 'sseq']
-                )
-    blast = pd.read_csv(blast_output, delimiter='\t')
-    sseqs = pd.read_csv(output_dir.rstrip('/')+'/'+subject_tsv, delimiter='\t')
-    qseqs = pd.read_csv(output_dir.rstrip('/')+'/'+query_tsv, delimiter='\t')
+def filter_blast_output(lines, output_file, outfmt,
+                        pident_threshold=0, cov_threshold=0):
+    """ Write blast tabular output lines into open output_file \
+        with header line (from outfmt), keeping only hits above \
+        identity percentage and coverage thresholds.
+        Lines are streamed: memory does not depend on output size.
+        Return number of hits read and kept """
+    fields = outfmt.split()[1:]
+    thresholds = _thresholds(fields, pident_threshold, cov_threshold)
+    output_file.write('\t'.join(fields)+'\n')
+    n_read = 0
+    n_kept = 0
+    for line in lines:
+        n_read += 1
+        if _passes(line, thresholds):
+            output_file.write(line)
+            n_kept += 1
+    return n_read, n_kept
+
+
+def _thresholds(fields, pident_threshold=0, cov_threshold=0):
+    """ Return (column index, threshold) of identity percentage \
+        and coverage. Filter only by columns present in output fields """
+    return [(fields.index(field), float(threshold or 0))
+            for field, threshold in (('pident', pident_threshold),
+                                     ('qcovs', cov_threshold))
+            if field in fields]
+
+
+def _passes(line, thresholds):
+    """ Whether blast output line is above every threshold """
+    values = line.rstrip('\n').split('\t')
+    return all(float(values[idx]) >= threshold
+               for idx, threshold in thresholds)
+
+
+def stream_blast(query_fasta, database_path, sequence_type, e_value,
+                 cov_threshold=0,  pident_threshold=0,
+                 outfmt='6 qseqid sseqid qcovs qstart qend pident evalue',
+                 log='/dev/null', shards=1, threads=1, members=None,
+                 dbsize=None):
+    """ Run blast as blast_compute does, reading its output as it is \
+        produced. Yield (qseqid, kept hit lines, number of hits read) \
+        for each query as soon as its hits are final: blast reports \
+        queries one after the other, so hits of a query are final \
+        once next query (or end of output) is read. \
+        Raise RuntimeError once output is read if blast failed """
+    fields = outfmt.split()[1:]
+    thresholds = _thresholds(fields, pident_threshold, cov_threshold)
+    if shards <= 1:
+        query_files = [query_fasta]
+    else:
+        query_files, dummy_order = split_fasta(query_fasta, shards,
+                                               query_fasta+'.shard')
+    log_file = open(log, 'a+')
+    processes = [Popen(
+                       _blast_command(sequence_type, query_file,
+                                      database_path, e_value, outfmt,
+                                      threads, dbsize=dbsize),
+                       stdout=PIPE, stderr=log_file,
+                       universal_newlines=True
+                      ) for query_file in query_files]
+    # One reader thread per blast process, queries handed in order found.
+    # Bounded, so blast is held back while hits are not consumed
+    found = queue.Queue(maxsize=2*len(processes))
+    returncodes = [None] * len(processes)
+
+    def read_output(idx, process):
+        for qseqid, lines in itertools.groupby(
+                           process.stdout,
+                           key=lambda line: line.split('\t', 1)[0]):
+            found.put((qseqid, list(lines)))
+        returncodes[idx] = process.wait()
+        found.put(None)
+
+    readers = [threading.Thread(target=read_output, args=(idx, process))
+               for idx, process in enumerate(processes)]
+    for reader in readers: reader.start()
+    try:
+        finished = 0
+        while finished < len(readers):
+            item = found.get()
+            if item is None:
+                finished += 1
+                continue
+            qseqid, lines = item
+            if members: lines = list(expand_hits(lines, members, outfmt))
+            yield qseqid, [line for line in lines
+                           if _passes(line, thresholds)], len(lines)
+        # Hits of a failed blast are incomplete: nothing is to be kept
+        if any(returncodes): raise RuntimeError('blastp failed, see '+log)
+    finally:
+        # Consumer gone early: stop blast and unblock readers
+        for process in processes:
+            if process.poll() is None: process.kill()
+        while any(reader.is_alive() for reader in readers):
+            try: found.get(timeout=0.1)
+            except queue.Empty: pass
+        for reader in readers: reader.join()
+        log_file.close()
+        if shards > 1:
+            for query_file in query_files: os.remove(query_file)
+
+
+def add_sequences(blast, subject_seqs, query_seqs):
+    """ Return blast output (dataframe) with complete subject \
+        and query sequences and query length, given subject sequences \
+        {sseqid: sseq} and query (qseqid, qseq) pairs """
+    import pandas as pd
+    # Typed even if empty (no hits), so that merging on sseqid works
+    sseqs = pd.DataFrame(dict(sseqid=pd.Series(list(subject_seqs.keys()),
+                                               dtype=str),
+                              sseq=pd.Series(list(subject_seqs.values()),
+                                             dtype=str)))
+    qseqs = pd.DataFrame(query_seqs, columns=['qseqid', 'qseq'])
+    qseqs['qseqlen'] = qseqs.qseq.apply(len)
     # Merge dataframes by sseqid
     blast_sseqs = pd.merge(left=blast, right=sseqs, on='sseqid')
-    merged = pd.merge(left=blast_sseqs, right=qseqs, on='qseqid')
-    merged.to_csv(output_dir.rstrip('/')+'/'+os.path.basename(output_filename),
-                  index=False, sep='\t')
-    if remove_files:
-        os.remove(output_dir.rstrip('/')+'/'+query_tsv)
-        os.remove(output_dir.rstrip('/')+'/'+subject_tsv)
-    return
+    return pd.merge(left=blast_sseqs, right=qseqs, on='qseqid')
+
+
+def retrieve_seqs(query_fasta, subject_multifasta, blast_output, output_dir,
+                  output_filename='_blast_output.tsv', export_tsv=False,
+                  index_cache=None, index_sources=None):
+    """ Include complete hit subject and query sequences \
+        in blast_output (tsv file or table in memory, see fh.read_blast). \
+        Only subject sequences with hits are read from subject_multifasta \
+        (see fh.fetch_seqs, its index stored in index_cache \
+        if given, keyed by index_sources). Result is stored normalized inside \
+        output_dir (see fh.write_hits), and exported to output_filename \
+        if export_tsv; later stages can take the returned table \
+        instead of reading it back.
+        Return blast output with sequences (dataframe) """
+    from Bio.SeqIO.FastaIO import SimpleFastaParser
+    import pandas as pd
+    import file_handler as fh
+    if not os.path.isdir(output_dir): os.mkdir(output_dir)
+    blast = fh.read_blast(blast_output)
+    subject_seqs = fh.fetch_seqs(subject_multifasta, pd.unique(blast.sseqid),
+                                 cache_dir=index_cache,
+                                 sources=index_sources)
+    with open(query_fasta, 'r') as fasta:
+        query_seqs = [(title.split(None, 1)[0], sequence)
+                      for title, sequence in SimpleFastaParser(fasta)]
+    merged = add_sequences(blast, subject_seqs, query_seqs)
+    fh.write_hits(merged, output_dir, export_tsv, output_filename)
+    return merged
 
 
 def main():
@@ -1,4 +1,5 @@
 #!/usr/bin/env python
+import hashlib
 import os
 import re
 from subprocess import call, PIPE, Popen
@@ -6,7 +7,28 @@ from subprocess import call, PIPE, Popen
 from Bio.SeqIO.FastaIO import SimpleFastaParser
 import numpy as np
 import pandas as pd
+from pyarrow import feather
 
+# Column types of blast output tables (other columns are inferred)
+BLAST_DTYPES = {'qseqid': str, 'sseqid': str, 'qcovs': 'int64',
+                'qstart': 'int64', 'qend': 'int64', 'pident': 'float64',
+                'evalue': 'float64', 'sseq': str, 'qseq': str,
+                'qseqlen': 'int64'}
+# Default directory of FASTA indexes keyed by content (see index_fasta)
+INDEX_CACHE = os.path.expanduser('~/.cache/BlasTreeDom/fasta_indexes')
+# Normalized blast output with sequences (see write_hits)
+HITS_FILE = '_hits.feather'
+SEQS_FILE = '_seqs.feather'
+
+
+def file_hash(filename, salt=b''):
+    """ Return sha256 hex digest of salt followed by file content, \
+        read in chunks """
+    sha = hashlib.sha256(salt)
+    with open(filename, 'rb') as handle:
+        for chunk in iter(lambda: handle.read(1 << 20), b''):
+            sha.update(chunk)
+    return sha.hexdigest()
 
 
 def list_all(input_list):
@@ -67,48 +89,252 @@ def fasta2tsv(fasta_file, output_dir, output_filename,
     return
 
 
-def tsv2fasta(tsv_file, output_dir, separate_dirs=False):
+def _read_index(index_file, signature):
+    """ Return FASTA index stored in index_file (see index_fasta), \
+        None if missing or stored for another signature """
+    if not os.path.exists(index_file): return None
+    index = {}
+    with open(index_file, 'r') as handle:
+        if handle.readline() != signature: return None
+        for line in handle:
+            identifier, offset, length = line.rsplit('\t', 2)
+            index[identifier] = (int(offset), int(length))
+    return index
+
+
+def _write_atomic(filename, lines):
+    """ Write lines to filename through a temporary file, so that \
+        partial files are never exposed. Failures (e.g. read-only \
+        directory or full disk) are ignored """
+    tmp_file = '{}.{}.tmp'.format(filename, os.getpid())
+    try:
+        os.makedirs(os.path.dirname(os.path.abspath(filename)),
+                    exist_ok=True)
+        with open(tmp_file, 'w') as handle:
+            handle.writelines(lines)
+        os.replace(tmp_file, filename)
+    except OSError:
+        if os.path.exists(tmp_file): os.remove(tmp_file)
+
+
+def index_fasta(fasta_file, index_file=None, cache_dir=None, sources=None):
+    """ Return {sequence id: (offset, length)} in bytes of every record \
+        in FASTA file. Index is stored in index_file \
+        (default: fasta_file.idx) and rebuilt only if \
+        FASTA file size or modification time change. \
+        If cache_dir is given, index is stored there keyed by FASTA \
+        content instead, so that runs on copies of the same file \
+        (e.g. in different results directories) reuse it. \
+        Content is only hashed if paths, sizes and modification times \
+        of sources (files FASTA file was built from, default: itself) \
+        and FASTA file size were not seen before """
+    if cache_dir is not None:
+        cache_dir = cache_dir.rstrip('/')+'/'
+        stamp = hashlib.sha256()
+        for source in sources or [fasta_file]:
+            stat = os.stat(source)
+            stamp.update('{}\t{}\t{}\n'.format(os.path.abspath(source),
+                                                stat.st_size,
+                                                stat.st_mtime_ns).encode())
+        stamp.update(str(os.path.getsize(fasta_file)).encode())
+        # Sources seen before: content key stored, no need to hash
+        key_file = cache_dir+stamp.hexdigest()+'.key'
+        if os.path.exists(key_file):
+            with open(key_file, 'r') as handle:
+                digest = handle.read().strip()
+            index = _read_index(cache_dir+digest+'.idx', digest+'\n')
+            if index is not None: return index
+        digest = file_hash(fasta_file)
+        _write_atomic(key_file, [digest+'\n'])
+        index_file = cache_dir+digest+'.idx'
+        signature = digest+'\n'
+    else:
+        if index_file is None: index_file = fasta_file+'.idx'
+        stat = os.stat(fasta_file)
+        signature = '{}\t{}\n'.format(stat.st_size, stat.st_mtime_ns)
+    index = _read_index(index_file, signature)
+    if index is not None: return index
+    index = {}
+    identifier = None
+    offset = 0
+    with open(fasta_file, 'rb') as fasta:
+        for line in fasta:
+            if line.startswith(b'>'):
+                if identifier is not None and identifier not in index:
+                    index[identifier] = (start, offset - start)
+                identifier = line[1:].split(None, 1)[0].decode()
+                start = offset
+            offset += len(line)
+    if identifier is not None and identifier not in index:
+        index[identifier] = (start, offset - start)
+    # Kept in memory only if it cannot be stored
+    _write_atomic(index_file, [signature]+['{}\t{}\t{}\n'.format(
+                                            identifier, offset, length)
+                                            for identifier, (offset, length)
+                                            in index.items()])
+    return index
+
+
+def fetch_seqs(fasta_file, identifiers, index_file=None, index=None,
+               cache_dir=None, sources=None):
+    """ Return {sequence id: sequence} for given ids found in FASTA file, \
+        reading only those records (see index_fasta). \
+        Index already loaded can be given """
+    if index is None: index = index_fasta(fasta_file, index_file, cache_dir,
+                                          sources)
+    locations = sorted(index[identifier] for identifier in set(identifiers)
+                       if identifier in index)
+    seqs = {}
+    with open(fasta_file, 'rb') as fasta:
+        for offset, length in locations:
+            fasta.seek(offset)
+            lines = fasta.read(length).decode().split('\n')
+            sequence = ''.join(line.rstrip() for line in lines[1:])
+            seqs[lines[0][1:].split(None, 1)[0]] = sequence.replace(' ', '')\
+                                                           .replace('\r', '')
+    return seqs
+
+
+def tsv2fasta(tsv_file, output_dir, separate_dirs=False, include_query=False):
     """ Create FASTA file with subject sequences \
-        for each query id in tsv_file (dataframe).
+        for each query id in tsv_file (or blast output table \
+        already in memory, see read_blast), in a single pass.
+        Query sequence is appended if include_query.
         FASTA filename(s) in output_dir or query-specific directory:  \
         unaligned.fasta """
-    df = pd.read_csv(tsv_file, delimiter='\t')
-    for qseqid in pd.unique(df.qseqid):
+    df = read_blast(tsv_file)
+    for qseqid, data in df.groupby('qseqid', sort=False):
         if separate_dirs:
             filename = output_dir.rstrip('/')+'/{}/unaligned.fasta'\
-                                              .format(qseqid, qseqid)
+                                              .format(qseqid)
             os.makedirs(output_dir.rstrip('/')+'/'+qseqid, exist_ok=True)
         else: filename = output_dir.rstrip('/')+'/'+'unaligned.fasta'
-        data = df[df.qseqid == qseqid].reset_index(drop=True)
-        with open(filename, 'w') as fasta:
-            for idx in range(len(data.sseqid)):
-                fasta.write('>'+data.sseqid[idx]+'\n')
-                fasta.write(data.sseq[idx]+'\n')
+        hits2fasta(data, filename, include_query)
+    return
+
+
+def hits2fasta(data, filename, include_query=False):
+    """ Write subject sequences of blast hits of a single query \
+        (dataframe) into FASTA file, followed by query sequence \
+        if include_query """
+    with open(filename, 'w') as fasta:
+        fasta.writelines('>'+sseqid+'\n'+sseq+'\n'
+                         for sseqid, sseq in zip(data.sseqid, data.sseq))
+        if include_query:
+            fasta.write('>'+data.qseqid.iloc[0]+'\n'+data.qseq.iloc[0]+'\n')
     return
 
 
-def merge_results(blast_output, genBank_tsv, output_dir,
+def read_blast(blast_output, columns=None):
+    """ Return blast output table (dataframe) read from tsv file, \
+        or as given if already in memory. Optionally only given columns """
+    if isinstance(blast_output, pd.DataFrame):
+        if columns is None: return blast_output
+        return blast_output[columns]
+    # Round-trip parsing: e-values read back equal those written
+    return pd.read_csv(blast_output, delimiter='\t', usecols=columns,
+                       dtype=BLAST_DTYPES, float_precision='round_trip')
+
+
+def write_hits(data, output_dir, export_tsv=False,
+               tsv_filename='_blast_output.tsv'):
+    """ Store blast output with sequences (see bl.add_sequences) \
+        inside output_dir as hit table referencing sequences by id \
+        (_hits.feather, categorical ids) and table of distinct \
+        subject and query sequences (_seqs.feather). Both uncompressed, \
+        so that they can be memory-mapped (see read_hits).
+        Export to tsv_filename (sequences in every row) if requested """
+    output_dir = output_dir.rstrip('/')+'/'
+    hits = data.drop(columns=['sseq', 'qseq'])\
+               .astype({'qseqid': 'category', 'sseqid': 'category'})
+    seqs = pd.concat([pd.DataFrame(dict(seqid=data.sseqid,
+                                        sequence=data.sseq, query=False))
+                        .drop_duplicates('seqid'),
+                      pd.DataFrame(dict(seqid=data.qseqid,
+                                        sequence=data.qseq, query=True))
+                        .drop_duplicates('seqid')],
+                     ignore_index=True)
+    hits.reset_index(drop=True).to_feather(output_dir+HITS_FILE,
+                                           compression='uncompressed')
+    seqs.to_feather(output_dir+SEQS_FILE, compression='uncompressed')
+    if export_tsv:
+        data.to_csv(output_dir+os.path.basename(tsv_filename),
+                    index=False, sep='\t')
+    return
+
+
+def read_hits(output_dir, columns=None):
+    """ Return blast output with sequences (dataframe) stored \
+        inside output_dir by write_hits, memory-mapping its tables. \
+        Optionally only given columns: sequences are only read \
+        if sseq or qseq are requested """
+    output_dir = output_dir.rstrip('/')+'/'
+    sequences = [column for column in ['sseq', 'qseq']
+                 if columns is None or column in columns]
+    # Memory-mapped: only selected columns are actually read
+    table = feather.read_table(output_dir+HITS_FILE, memory_map=True)
+    if columns is not None:
+        # Ids are needed to look sequences up
+        needed = set(columns) | {column+'id' for column in sequences}
+        table = table.select([column for column in table.column_names
+                              if column in needed])
+    hits = table.to_pandas()
+    hits = hits.astype({column: str for column in ['qseqid', 'sseqid']
+                        if column in hits})
+    if sequences:
+        seqs = feather.read_table(output_dir+SEQS_FILE,
+                                  memory_map=True).to_pandas()
+        for column in sequences:
+            lookup = seqs[seqs['query'] == (column == 'qseq')]\
+                         .set_index('seqid').sequence
+            position = hits.columns.get_loc('qseqlen') \
+                       if 'qseqlen' in hits else len(hits.columns)
+            hits.insert(position, column, hits[column+'id'].map(lookup))
+    if columns is not None: hits = hits[columns]
+    return hits
+
+
+def read_table(filename, columns=None):
+    """ Read feather or tsv table, loading only given columns """
+    if filename.endswith('.feather'):
+        return pd.read_feather(filename, columns=columns)
+    return pd.read_csv(filename, delimiter='\t', usecols=columns)
+
+
+def _domain_names(names):
+    """ Space-separated quoted unique domain names """
+    return ' '.join("'{}'".format(name) for name in pd.unique(names))
+
+
+def merge_results(blast_output, genBank_info, output_dir,
                   output_filename, include_gb=False):
-    """ Merge blast_output, genBank parsed fields \
+    """ Merge blast_output (tsv file in output_dir or table \
+        already in memory, see read_blast), genBank parsed fields \
         and extracted ProSite domain names \
-        to create an integrated ouput file """
-    blast = pd.read_csv(output_dir.rstrip('/')+'/'
-                        +os.path.basename(blast_output),
-                        delimiter='\t').drop(columns=['qseqlen'])
-    domains = []
-    for qid in pd.unique(blast.qseqid):
-        data = blast[blast.qseqid == qid]
-        domain_file = pd.read_csv(output_dir.rstrip('/')+'/'+qid+'/'
-                                  +'domains/_domains.tsv', delimiter='\t')
-        for sseqid in pd.unique(data.sseqid):
-            domains.append(str(pd.unique(
-                                    domain_file[domain_file.id == sseqid].name))
-                               .lstrip('[')
-                               .rstrip(']')
-                               )
-    blast.insert(loc=7, column='domains',
-                 value=pd.Series(domains, name='domains'),
-                 allow_duplicates=True)
+        to create an integrated ouput file. Return number of rows """
+    if not isinstance(blast_output, pd.DataFrame):
+        blast_output = output_dir.rstrip('/')+'/'\
+                       +os.path.basename(blast_output)
+    blast = read_blast(blast_output).drop(columns=['qseqlen'])
+    if len(blast):
+        # Domain names of every (qseqid, sseqid) from all per-query tables
+        domains = pd.concat([pd.read_csv(output_dir.rstrip('/')+'/'+qid+'/'
+                                         +'domains/_domains.tsv',
+                                         delimiter='\t',
+                                         usecols=['id', 'name'], dtype=str)
+                               .assign(qseqid=qid)
+                             for qid in pd.unique(blast.qseqid)],
+                            ignore_index=True)
+        domains = domains.groupby(['qseqid', 'id'], sort=False).name\
+                         .agg(_domain_names).reset_index()\
+                         .rename(columns={'id': 'sseqid',
+                                          'name': 'domains'})
+        blast = pd.merge(left=blast, right=domains,
+                         on=['qseqid', 'sseqid'], how='left')
+        domains = blast.pop('domains').fillna('')
+    # No hits: no per-query domain tables to read
+    else: domains = pd.Series([], dtype=str)
+    blast.insert(loc=7, column='domains', value=domains)
     if include_gb:
         fields0 = [
                    'protein_id', 'gene', 'locus_tag',
@@ -118,22 +344,22 @@ def merge_results(blast_output, genBank_tsv, output_dir,
                   'sseqid', 'gene', 'locus_tag',
                   'EC_number', 'product', 'db_xref'
                  ]
-        genBank = pd.read_csv(output_dir.rstrip('/')+'/'
-                              +os.path.basename(genBank_tsv), delimiter='\t')\
-                              .rename(columns=dict(zip(fields0, fields)))
-        merged_df = pd.merge(left=genBank, right=blast, on='sseqid')
-        columns = merged_df.columns.values
-        columns = np.delete(columns, np.argwhere(columns=='qseqid'))
-        columns = np.append(np.array(['qseqid']), columns)
-        merged_df = merged_df[columns]
-        merged_df.to_csv(output_dir.rstrip('/')+'/'
-                         +os.path.basename(output_filename),
-                         index=False, sep='\t')
+        genBank = read_table(output_dir.rstrip('/')+'/'
+                             +os.path.basename(genBank_info),
+                             columns=['record_name']+fields0)\
+                             .rename(columns=dict(zip(fields0, fields)))\
+                             .drop_duplicates(subset='sseqid')
+        merged_df = pd.merge(left=blast, right=genBank, on='sseqid',
+                             how='left')
+        # qseqid first, then genBank fields and blast results
+        columns = ['qseqid'] + list(genBank.columns)
+        merged_df = merged_df[columns + [column for column in blast.columns
+                                         if column not in columns]]
     else:
         merged_df = blast
     merged_df = merged_df.sort_values(by=['qseqid', 'qcovs', 'pident'],
-                                      ascending=[1, 0, 0])
+                                      ascending=[1, 0, 0], kind='stable')
     merged_df.to_csv(output_dir.rstrip('/')+'/'
                      +os.path.basename(output_filename),
                      index=False, sep='\t')
-    return
+    return len(merged_df)
@@ -1,106 +1,217 @@
 #!/usr/bin/env python
 
+import io
 import os
+import shutil
 import sys
 import csv
+import time
+from concurrent.futures import ProcessPoolExecutor
+from contextlib import contextmanager
 
 from Bio import SeqIO
 import numpy as np
 import pandas as pd
+import pyarrow as pa
 
 import file_handler as fh
 
-def gb_parser(genBank, sequence_type, output_dir=None,
-              output_file = None, parse_fields=False):
-    """ Parse GenBank file and extract all CDS.
-        Return or create file containing nucleotide or protein sequences \
-        in multifasta depending on sequence_type """
-    multifasta = ""
-    if parse_fields:
-        fields = [
-                  'protein_id', 'gene', 'locus_tag',
-                  'EC_number', 'product', 'db_xref'
-                  ]
-        data = [ [] for dummy_field in fields ]
+GB_FIELDS = [
+             'protein_id', 'gene', 'locus_tag',
+             'EC_number', 'product', 'db_xref'
+            ]
+GB_INFO_COLUMNS = ['record_name'] + GB_FIELDS
+# Number of FASTA records buffered before being written to output
+WRITE_CHUNK = 1000
+
+
+def _qualifier(feature, field):
+    """ Return feature qualifier as plain string ('N/A' if missing) """
+    try:
+        value = feature.qualifiers[field]
+    except KeyError:
+        return 'N/A'
+    for char in "[]'":
+        value = str(value).strip(char)
+    return value
+
+
+def iter_cds(genBank, sequence_type, parse_fields=False):
+    """ Iterate over CDS in GenBank file.
+        Yield (record name, FASTA record, info fields) for each CDS \
+        with nucleotide or protein sequence depending on sequence_type. \
+        Info fields (record name and qualifiers) are only parsed \
+        if requested """
     with open(genBank, 'r') as input_handle:
         for record in SeqIO.parse(input_handle, "genbank"):
             seq = record.seq # DNA sequence
-            record_name = record.name
             for feature in record.features:
+                if feature.type != 'CDS': continue
                 start = feature.location.start # Start position in genome
                 end = feature.location.end # End position in genomic sequence
                 strand = feature.location.strand # Positive or negative strand
-                if feature.type == 'CDS':
-                    try:
-                        try:
-                            multifasta += ">"\
-                                          + feature.qualifiers['protein_id'][0]\
-                                          + " "
-                        except:
-                            multifasta += ">"
-                        try:
-                            multifasta += feature.qualifiers['product'][0] + " "
-                        except:
-                            pass
-                        multifasta += record.name + "\n"
-                        if sequence_type == "prot":
-                            multifasta += feature.qualifiers['translation'][0]\
-                                          + "\n"
-                        else:
-                            if strand > 0:
-                                multifasta += seq[start : end] + "\n"
-                            else:
-                                # If strand is negative,
-                                # the coding sequence is
-                                # the reverse complementary
-                                multifasta += seq[start : end]\
-                                              .reverse_complement() + "\n"
-                        if parse_fields:
-                            for idx in range(len(fields)):
-                                try:
-                                    field = feature.qualifiers[fields[idx]]
-                                    for char in "[]'":
-                                        field = str(field).strip(char)
-                                    data[idx].append(field)
-                                except:
-                                    data[idx].append('N/A')
-                    except: pass
-    # Create tsv file containing parsed info from features.qualifiers
-    if parse_fields:
-        genBank_tsv = output_dir.rstrip('/')+'/'+'_genBank_info.tsv'
-        df = pd.DataFrame()
-        df['record_name'] = pd.Series(np.full(len(data[0]), record_name),
-                                      name='record_name')
-        for idx in range(len(fields)):
-            df[fields[idx]] = pd.Series(data[idx], name=fields[idx])
-        # If file already exists, append newly parsed genBank fields
-        if os.path.exists(genBank_tsv):
-            previous_tsv = pd.read_csv(genBank_tsv, delimiter='\t')
-            df = previous_tsv.append(other=df, ignore_index=True)
-        df.to_csv(genBank_tsv, index=False, sep='\t')
+                header = ">"
+                if 'protein_id' in feature.qualifiers:
+                    header += feature.qualifiers['protein_id'][0] + " "
+                if 'product' in feature.qualifiers:
+                    header += feature.qualifiers['product'][0] + " "
+                header += record.name + "\n"
+                try:
+                    if sequence_type == "prot":
+                        sequence = feature.qualifiers['translation'][0]
+                    elif strand > 0:
+                        sequence = str(seq[start : end])
+                    else:
+                        # If strand is negative,
+                        # the coding sequence is the reverse complementary
+                        sequence = str(seq[start : end].reverse_complement())
+                except Exception:
+                    # CDS without sequence (e.g. pseudogenes) are skipped
+                    continue
+                fields = None
+                if parse_fields:
+                    fields = [record.name] + [_qualifier(feature, field)
+                                              for field in GB_FIELDS]
+                yield record.name, header + sequence + "\n", fields
+
+
+def _stream_cds(genBank, sequence_type, output_handle, parse_fields=False):
+    """ Stream CDS of GenBank file into open FASTA output_handle, \
+        writing records in chunks of WRITE_CHUNK.
+        Return number of CDS written and info fields of each CDS \
+        (if parse_fields) """
+    chunk = []
+    data = []
+    n_cds = 0
+    for dummy_name, fasta_record, fields in iter_cds(genBank, sequence_type,
+                                                     parse_fields):
+        chunk.append(fasta_record)
+        if parse_fields: data.append(fields)
+        if len(chunk) >= WRITE_CHUNK:
+            output_handle.writelines(chunk)
+            chunk = []
+        n_cds += 1
+    output_handle.writelines(chunk)
+    return n_cds, data
+
+
+@contextmanager
+def genBank_info_writer(output_dir, export_tsv=False):
+    """ Open columnar _genBank_info.feather inside output_dir \
+        (and _genBank_info.tsv if requested). Yield function storing \
+        info fields of a batch of parsed CDS, so that only one batch \
+        (e.g. one genBank file) is held in memory at a time """
+    output = output_dir.rstrip('/')+'/'+'_genBank_info'
+    schema = pa.schema([(column, pa.string())
+                        for column in GB_INFO_COLUMNS])
+    tsv = open(output+'.tsv', 'w') if export_tsv else None
+    try:
+        if tsv: tsv.write('\t'.join(GB_INFO_COLUMNS)+'\n')
+        with pa.OSFile(output+'.feather', 'wb') as sink, \
+             pa.ipc.new_file(sink, schema) as writer:
+
+            def write(data):
+                if not data: return
+                writer.write_batch(pa.record_batch(
+                                   [pa.array(column, pa.string())
+                                    for column in zip(*data)],
+                                   schema=schema))
+                if tsv: pd.DataFrame(data, columns=GB_INFO_COLUMNS)\
+                          .to_csv(tsv, header=False, index=False, sep='\t')
+
+            yield write
+    finally:
+        if tsv: tsv.close()
+
+
+def write_genBank_info(data, output_dir, export_tsv=False):
+    """ Store info fields of parsed CDS in columnar \
+        _genBank_info.feather inside output_dir.
+        Export to _genBank_info.tsv if requested """
+    with genBank_info_writer(output_dir, export_tsv) as write: write(data)
+
+
+def write_cds(genBank, sequence_type, output_handle, output_dir=None,
+              parse_fields=False, export_tsv=False):
+    """ Stream CDS of GenBank file into open FASTA output_handle.
+        If parse_fields, store info fields (see write_genBank_info) \
+        inside output_dir. Return number of CDS written """
+    n_cds, data = _stream_cds(genBank, sequence_type, output_handle,
+                              parse_fields)
+    # Create table containing parsed info from features.qualifiers
+    if parse_fields: write_genBank_info(data, output_dir, export_tsv)
+    return n_cds
+
+
+def _parse_to_part(genBank, sequence_type, part_file):
+    """ Parse GenBank file into its own FASTA part_file.
+        Return number of CDS, info fields and parsing time """
+    time0 = time.time()
+    with open(part_file, 'w', buffering=1 << 20) as output_handle:
+        n_cds, data = _stream_cds(genBank, sequence_type, output_handle,
+                                  parse_fields=True)
+    return n_cds, data, time.time() - time0
+
+
+def gb_parser(genBank, sequence_type, output_dir=None,
+              output_file = None, parse_fields=False, export_tsv=False):
+    """ Parse GenBank file and extract all CDS.
+        Return or create file containing nucleotide or protein sequences \
+        in multifasta depending on sequence_type """
     # Create .fasta file containing nucleotide/protein sequences
     if output_file:
-        output = open(str(output_file) + ".fasta", 'a+')
-        output.write(multifasta)
-        output.close()
+        with open(str(output_file) + ".fasta", 'a+') as output:
+            write_cds(genBank, sequence_type, output, output_dir=output_dir,
+                      parse_fields=parse_fields, export_tsv=export_tsv)
         return
     # If no output_file is inputed, return multifasta
-    return multifasta
+    multifasta = io.StringIO()
+    write_cds(genBank, sequence_type, multifasta, output_dir=output_dir,
+              parse_fields=parse_fields, export_tsv=export_tsv)
+    return multifasta.getvalue()
 
 
-def parse_gbs(genBanks, sequence_type, output_dir, output_filename):
+def parse_gbs(genBanks, sequence_type, output_dir, output_filename,
+              workers=1, export_tsv=False):
     """ Generate multifasta with all sequences in all genBank files \
-        in input directory """
+        in input directory. CDS are streamed into output file \
+        and their info fields stored file by file \
+        (see genBank_info_writer).
+        With several workers, files are parsed in a process pool \
+        and merged in input order.
+        Return number of genBank files and of CDS """
     genBank_list = fh.list_all(genBanks)
-    genBank_multifasta = ""
-    for genBank_doc in genBank_list:
-        genBank_multifasta += gb_parser(
-                                        genBank=genBank_doc,
-                                        sequence_type=sequence_type,
-                                        output_dir=output_dir,
-                                        parse_fields=True
-                                        )
     output = output_dir.rstrip('/')+'/'+os.path.basename(output_filename)
-    with open(output, "w") as  output_file:
-        output_file.write(genBank_multifasta)
-    return
+    n_cds_total = 0
+    with open(output, "w", buffering=1 << 20) as output_file, \
+         genBank_info_writer(output_dir, export_tsv) as write_info:
+        if workers <= 1:
+            for genBank_doc in genBank_list:
+                time0 = time.time()
+                n_cds, gb_data = _stream_cds(
+                                             genBank=genBank_doc,
+                                             sequence_type=sequence_type,
+                                             output_handle=output_file,
+                                             parse_fields=True
+                                             )
+                write_info(gb_data)
+                n_cds_total += n_cds
+                print('  {}: {} CDS in {:.2f}s'.format(
+                      genBank_doc, n_cds, time.time() - time0))
+        else:
+            parts = ['{}.{}.part'.format(output, idx)
+                     for idx in range(len(genBank_list))]
+            with ProcessPoolExecutor(max_workers=workers) as pool:
+                results = pool.map(_parse_to_part, genBank_list,
+                                   [sequence_type]*len(genBank_list), parts)
+                # Results come back in input order
+                for genBank_doc, part, (n_cds, gb_data, elapsed)\
+                        in zip(genBank_list, parts, results):
+                    with open(part, 'r') as part_file:
+                        shutil.copyfileobj(part_file, output_file, 1 << 20)
+                    os.remove(part)
+                    write_info(gb_data)
+                    n_cds_total += n_cds
+                    print('  {}: {} CDS in {:.2f}s'.format(
+                          genBank_doc, n_cds, elapsed))
+    return len(genBank_list), n_cds_total
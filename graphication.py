@@ -1,93 +1,219 @@
 #!/usr/bin/env python
 
+import hashlib
+import json
+import multiprocessing
 import os
 import re
+from concurrent.futures import ProcessPoolExecutor
 
 import numpy as np
 import pandas as pd
+import matplotlib
+matplotlib.use('Agg') # Headless backend, also in worker processes
 import matplotlib.pyplot as plt
 import seaborn as sns
 
-import prosite_parser as prop
+import file_handler as fh
 
+# Bump whenever figures change for the same input rows
+RENDER_VERSION = 1
 
-def blast_plot(blast_output, output_dir):
-    """ Plot blast output for each of the queries provided in input file """
-    df = pd.read_csv(blast_output, delimiter='\t')
-    df = df.sort_values(['qseqid', 'qcovs', 'pident', 'evalue'],
-                        ascending=[1, 0, 0, 0]).reset_index(drop=True)
+
+def _set_theme():
+    """ Seaborn theme shared by all figures """
+    sns.set(context='paper', font_scale=.9, font='times')
+    sns.set_style('white')
+
+
+def _render_hash(figure_input):
+    """ Return hash of figure input rows (JSON serializable) """
+    return hashlib.sha1(json.dumps([RENDER_VERSION, figure_input])
+                        .encode()).hexdigest()
+
+
+def _up_to_date(figure, digest):
+    """ Whether figure was already rendered from input with given hash \
+        (stored alongside the figure as figure.sha1) """
+    if not os.path.exists(figure) or not os.path.exists(figure+'.sha1'):
+        return False
+    with open(figure+'.sha1', 'r') as hash_file:
+        return hash_file.read().strip() == digest
+
+
+def render_pool(workers):
+    """ Return process pool drawing figures (see _render), \
+        which can be shared by threads: pyplot is not thread-safe. \
+        Workers are started by a fork server, not forked from \
+        the (multi-threaded) calling process """
+    return ProcessPoolExecutor(max_workers=workers, initializer=_set_theme,
+                               mp_context=multiprocessing
+                                          .get_context('forkserver'))
+
+
+def _render(draw, jobs, workers=1, pool=None):
+    """ Draw figures not rendered yet from the same input \
+        (jobs of (figure input, figure)), in given process pool \
+        (see render_pool) or in a new one if several workers. \
+        Return number of figures drawn and skipped """
+    pending = []
+    for figure_input, figure in jobs:
+        digest = _render_hash(figure_input)
+        if not _up_to_date(figure, digest):
+            pending.append((figure_input, figure, digest))
+    if pool is not None and pending:
+        for dummy in pool.map(draw, *zip(*pending)): pass
+    elif workers > 1 and len(pending) > 1:
+        with ProcessPoolExecutor(max_workers=workers,
+                                 initializer=_set_theme) as pool:
+            for dummy in pool.map(draw, *zip(*pending)): pass
+    else:
+        for figure_input, figure, digest in pending:
+            draw(figure_input, figure, digest)
+    return len(pending), len(jobs) - len(pending)
+
+
+def _draw_blast(data, figure, digest):
+    """ Draw blast plot of query from its hits (dict of columns) """
+    query = data['qseqid'][0]
+    data = pd.DataFrame(data)
+    fig, ax = plt.subplots(figsize=(8,8), clear=True)
+    # Plot totality of query (100% coverage)
+    sns.barplot(data=data, x='qseqlen', y='sseqid' , color="lightgrey")
+    # Plot coverage
+    sns.barplot(data=data, x="qend", y="sseqid", hue='pident greater than',
+                hue_order=list(range(10,110,10)),
+                palette=sns.light_palette('green', n_colors=10),
+                dodge=False) #dodge avoids hue shrinkage of width
+    # Plot N-terminal if uncovered
+    sns.barplot(data=data, x="qstart", y="sseqid", color='lightgrey')
+    ax.set_xlabel(xlabel='Blast overlap', **{'fontsize':11})
+    ax.set_ylabel(ylabel='subject Accession Number', **{'fontsize':11})
+    ax.set_title(label=str(query)+' blast output plot', **{'fontsize':13})
+    ax.legend(title='pident lower or equal to', loc='lower left',
+              bbox_to_anchor=(1, 0))
+    fig.tight_layout()
+    fig.savefig(figure)
+    plt.close(fig)
+    with open(figure+'.sha1', 'w') as hash_file: hash_file.write(digest)
+
+
+def _blast_job(data, output_dir):
+    """ Return blast figure job (see _render) of query hits (dataframe) """
+    data = data.sort_values(['qcovs', 'pident', 'evalue'],
+                            ascending=[0, 0, 0], kind='stable')
     # Use identity percentage to set color accordingly
-    df['pident greater than'] = round(df.pident / 10) * 10
-    for query in pd.unique(df.qseqid):
-        data = df[df.qseqid == query]
-        sns.set(context='paper', font_scale=.9, font='times')
-        sns.set_style('white')
-        fig, ax = plt.subplots(figsize=(8,8), clear=True)
-        # Plot totality of query (100% coverage)
-        sns.barplot(data=data, x='qseqlen', y='sseqid' , color="lightgrey")
-        # Plot coverage
-        sns.barplot(data=data, x="qend", y="sseqid", hue='pident greater than',
-                    hue_order=list(range(10,110,10)),
-                    palette=sns.light_palette('green', n_colors=10),
-                    dodge=False) #dodge avoids hue shrinkage of width
-        # Plot N-terminal if uncovered
-        sns.barplot(data=data, x="qstart", y="sseqid", color='lightgrey')
-        ax.set_xlabel(xlabel='Blast overlap', **{'fontsize':11})
-        ax.set_ylabel(ylabel='subject Accession Number', **{'fontsize':11})
-        ax.set_title(label=str(query)+' blast output plot', **{'fontsize':13})
-        ax.legend(title='pident lower or equal to', loc='lower left',
-                  bbox_to_anchor=(1, 0))
-        fig.tight_layout()
-        # Save figure in appropiate directory
-        graph_dir = output_dir.rstrip('/')+'/'+query+'/'
-        if not os.path.isdir(graph_dir): os.mkdir(graph_dir)
-        fig.savefig(graph_dir+'blast.png')
-        plt.close(fig)
-
-
-def domain_plot(blast_output, output_dir):
-    """ Plot ProSite protein domains of blast hits from input file """
-    df = pd.read_csv(blast_output, delimiter='\t')
-    idx=0 #Index to extract subject sequences
-    for qid in pd.unique(df.qseqid):
-        data = df[df.qseqid == qid]
-        query_dir = output_dir.rstrip('/')+'/'+qid+'/domains/'
-        os.makedirs(query_dir, exist_ok=True)
-        # Get previously extracted domains
-        doms = pd.read_csv(query_dir+'_domains.tsv', delimiter='\t')
-        for sseqid in data.sseqid:
-            subject = data[data.sseqid == sseqid]
-            seq_len = len(subject.sseq[idx])
-            domains = doms[doms.id == sseqid].name.to_numpy()
-            midpoints = doms[doms.id == sseqid].midpoint.to_numpy()
-            # Create different levels for domain name tags
-            levels = np.tile(np.arange(-9, 9 , 2),
-                             int(np.ceil(len(midpoints)/9)))[:len(midpoints)]
-            fig, ax = plt.subplots(figsize=(15, 9), constrained_layout=True)
-            ax.set_title(label="ProSite domains of "+str(sseqid),
-                         fontdict={'fontsize':13})
-            plt.axhline(y=0, color='black', linestyle='-')
-            # Represent domains as lines (and hollow dots) on the sequence
-            # Stem plot
-            markerline,\
-            dummy_stemline,\
-            dummy_baseline = ax.stem(midpoints, levels, linefmt="C3-",
-                                     basefmt="k-", use_line_collection=True)
-            plt.setp(markerline, mec="k", mfc="w", zorder=3)
-            # Shift the markers to the baseline by replacing the y-data by zeros
-            markerline.set_ydata(np.zeros(len(midpoints)))
-            # Annotate lines
-            vert = np.array(['top', 'bottom'])[(levels > 0).astype(int)]
-            for d, l, r, va in zip(midpoints, levels, domains, vert):
-                ax.annotate(r, xy=(d, l), xytext=(3, np.sign(l)*3),
-                            textcoords="offset points", va=va, ha="right",
-                            **{'fontsize':6, 'rotation':'vertical'})
-            # remove y axis
-            ax.get_yaxis().set_visible(False)
-            plt.ylim(-15, 13)
-            plt.xticks(list(range(0,seq_len, 50))+[seq_len],  **{'fontsize':9})
-            ax.set_xlabel(xlabel='protein sequence', **{'fontsize':11})
-            ax.margins(y=0.1)
-            fig.savefig("{}{}_domains.png".format(query_dir, sseqid))
-            plt.close(fig)
-            idx += 1
+    data = data.assign(**{'pident greater than':
+                          round(data.pident / 10) * 10})
+    columns = ['qseqid', 'sseqid', 'qseqlen', 'qstart', 'qend',
+               'pident greater than']
+    # Save figure in appropiate directory
+    graph_dir = output_dir.rstrip('/')+'/'+data.qseqid.iloc[0]+'/'
+    if not os.path.isdir(graph_dir): os.mkdir(graph_dir)
+    return data[columns].to_dict(orient='list'), graph_dir+'blast.png'
+
+
+def query_blast_plot(data, output_dir, pool=None):
+    """ Plot blast hits (dataframe) of a single query (see blast_plot), \
+        in given process pool if any (see render_pool).
+        Return number of figures drawn and unchanged """
+    _set_theme()
+    return _render(_draw_blast, [_blast_job(data, output_dir)], pool=pool)
+
+
+def blast_plot(blast_output, output_dir, workers=1):
+    """ Plot blast output for each of the queries provided in input file \
+        (or table in memory, see fh.read_blast).
+        Figures whose input rows did not change are not drawn again.
+        Return number of figures drawn and unchanged """
+    df = fh.read_blast(blast_output)
+    _set_theme()
+    jobs = [_blast_job(data, output_dir)
+            for dummy_query, data in df.groupby('qseqid', sort=True)]
+    drawn, skipped = _render(_draw_blast, jobs, workers)
+    print('  blast plots: {} drawn, {} unchanged'.format(drawn, skipped))
+    return drawn, skipped
+
+
+def _draw_domains(subject, figure, digest):
+    """ Draw ProSite domains of subject \
+        (sseqid, sequence length, domain names, domain midpoints) """
+    sseqid, seq_len, domains, midpoints = subject
+    midpoints = np.array(midpoints)
+    # Create different levels for domain name tags
+    levels = np.tile(np.arange(-9, 9 , 2),
+                     int(np.ceil(len(midpoints)/9)))[:len(midpoints)]
+    fig, ax = plt.subplots(figsize=(15, 9), constrained_layout=True)
+    ax.set_title(label="ProSite domains of "+str(sseqid),
+                 fontdict={'fontsize':13})
+    plt.axhline(y=0, color='black', linestyle='-')
+    # Represent domains as lines (and hollow dots) on the sequence
+    # Stem plot (nothing to represent if subject has no domains)
+    if len(midpoints):
+        markerline,\
+        dummy_stemline,\
+        dummy_baseline = ax.stem(midpoints, levels, linefmt="C3-",
+                                 basefmt="k-")
+        plt.setp(markerline, mec="k", mfc="w", zorder=3)
+        # Shift the markers to the baseline by replacing the y-data by zeros
+        markerline.set_ydata(np.zeros(len(midpoints)))
+    # Annotate lines
+    vert = np.array(['top', 'bottom'])[(levels > 0).astype(int)]
+    for d, l, r, va in zip(midpoints, levels, domains, vert):
+        ax.annotate(r, xy=(d, l), xytext=(3, np.sign(l)*3),
+                    textcoords="offset points", va=va, ha="right",
+                    **{'fontsize':6, 'rotation':'vertical'})
+    # remove y axis
+    ax.get_yaxis().set_visible(False)
+    plt.ylim(-15, 13)
+    plt.xticks(list(range(0,seq_len, 50))+[seq_len],  **{'fontsize':9})
+    ax.set_xlabel(xlabel='protein sequence', **{'fontsize':11})
+    ax.margins(y=0.1)
+    fig.savefig(figure)
+    plt.close(fig)
+    with open(figure+'.sha1', 'w') as hash_file: hash_file.write(digest)
+
+
+def _domain_jobs(data, output_dir, max_figures=None):
+    """ Return domain figure jobs (see _render) of query hits \
+        (dataframe), at most max_figures subjects """
+    data = data.drop_duplicates(subset='sseqid')
+    query_dir = output_dir.rstrip('/')+'/'+data.qseqid.iloc[0]+'/domains/'
+    os.makedirs(query_dir, exist_ok=True)
+    # Get previously extracted domains
+    doms = pd.read_csv(query_dir+'_domains.tsv', delimiter='\t',
+                       usecols=['id', 'name', 'midpoint'], dtype={'id': str})
+    doms = dict(list(doms.groupby('id', sort=False)))
+    jobs = []
+    for sseqid, sseq in list(zip(data.sseqid, data.sseq))[:max_figures]:
+        if sseqid in doms:
+            domains = doms[sseqid].name.tolist()
+            midpoints = doms[sseqid].midpoint.tolist()
+        else: domains, midpoints = [], []
+        jobs.append(((sseqid, len(sseq), domains, midpoints),
+                     "{}{}_domains.png".format(query_dir, sseqid)))
+    return jobs
+
+
+def query_domain_plot(data, output_dir, max_figures=None, pool=None):
+    """ Plot ProSite domains of blast hits (dataframe) of a single query \
+        (see domain_plot), in given process pool if any \
+        (see render_pool). Return number of figures drawn and unchanged """
+    _set_theme()
+    return _render(_draw_domains, _domain_jobs(data, output_dir, max_figures),
+                   pool=pool)
+
+
+def domain_plot(blast_output, output_dir, workers=1, max_figures=None):
+    """ Plot ProSite protein domains of blast hits from input file \
+        (or table in memory, see fh.read_blast).
+        At most max_figures subjects (in blast output order) \
+        are plotted per query. Figures whose input rows did not change \
+        are not drawn again. Return number of figures drawn and unchanged """
+    df = fh.read_blast(blast_output)
+    jobs = []
+    for dummy_qid, data in df.groupby('qseqid', sort=False):
+        jobs.extend(_domain_jobs(data, output_dir, max_figures))
+    drawn, skipped = _render(_draw_domains, jobs, workers)
+    print('  domain plots: {} drawn, {} unchanged'.format(drawn, skipped))
+    return drawn, skipped
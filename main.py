@@ -8,15 +8,13 @@ import time
 from datetime import datetime, timedelta
 from subprocess import call, PIPE, Popen
 
-from Bio import SeqIO
-import pandas as pd
-
+# Stage modules depending on pandas, Bio or matplotlib are imported
+# once arguments are valid and only by the stages that need them,
+# so that help and argument errors are returned fast
 import blast as bl
-import file_handler as fh
-import genbank_parser as gbp
-import graphication as graph
-import muscle as ms
-import prosite_parser as proparse
+import metrics
+import pipeline as pipe
+import streaming
 import user_interface as ui
 
 
@@ -54,6 +52,19 @@ def main():
                                   it can be provided. However, \
                                   original subject sequences are needed \
                                   (genBank or multifasta)')
+    arg_parser.add_argument('-db_cache', type=str, nargs='?',
+                            const=bl.DB_CACHE,
+                            help='Reuse BLAST databases from (and store \
+                                  them in) given cache directory. \
+                                  Default: "{}"'.format(bl.DB_CACHE))
+    arg_parser.add_argument('-db_cache_size', type=float,
+                            help='Maximum size (GB) of BLAST database cache')
+    arg_parser.add_argument('-blast_shards', type=int, default=1,
+                            help='Number of query shards searched \
+                                  by concurrent blast processes. Default: 1')
+    arg_parser.add_argument('-blast_threads', type=int, default=1,
+                            help='Number of threads of each blast process. \
+                                  Default: 1')
     arg_parser.add_argument('-pident', type=float,
                help='Identity percentage threshold for blast analysis')
     arg_parser.add_argument('-cov', type=float,
@@ -62,14 +73,63 @@ def main():
               help='E-value threshold for blast analysis')
     arg_parser.add_argument('-results_dir', type=str,
               help='Output directory to store results. Default: "results/"')
+    arg_parser.add_argument('-resume', type=str, metavar='results_dir',
+              help='Resume previous run stored in results_dir (same \
+                    command line), only running stages whose inputs \
+                    or parameters changed')
+    arg_parser.add_argument('-profile', type=str, nargs='+', default=[],
+              choices=['genBank', 'dedup', 'database', 'blast', 'blastp',
+                       'retrieve_seqs', 'alignment', 'domains', 'stream',
+                       'merge', 'graph'],
+              metavar='STEP',
+              help='Run given step(s) under cProfile, storing stats in \
+                    results_dir/_profile_STEP.prof')
     arg_parser.add_argument('-graph', action='store_true',
                help='Boolean to graph blast and domains analysis outputs')
+    arg_parser.add_argument('-max_figures', type=int,
+               help='Maximum number of domain figures per query')
+    arg_parser.add_argument('-workers', type=int, default=1,
+               help='Number of worker processes for parallel stages. \
+                     Default: 1')
+    arg_parser.add_argument('-stream', type=int, nargs='?',
+               const=streaming.IN_FLIGHT, metavar='N',
+               help='Start retrieval, alignment, tree, domains (and graphs) \
+                     of each query as soon as its blast hits are found, \
+                     processing up to N queries at once. \
+                     Default N: {}'.format(streaming.IN_FLIGHT))
+    arg_parser.add_argument('-tree_backend', choices=['muscle', 'numpy'],
+               default='muscle',
+               help='Compute N-J trees with MUSCLE or in-process (numpy). \
+                     Default: muscle')
+    arg_parser.add_argument('-export_tsv', action='store_true',
+               help='Export intermediate tables (e.g. genBank info) \
+                     also as tsv files')
+    arg_parser.add_argument('-dedup', action='store_true',
+               help='Collapse identical subject sequences into one \
+                     before building the blast database; hits are \
+                     expanded back to every subject id')
+    arg_parser.add_argument('-no_domain_cache', action='store_true',
+               help='Scan every sequence for ProSite domains \
+                     without using (nor updating) the domain cache')
     args = arg_parser.parse_args()
 
     if args.ui:
         args.query, args.genBank, args.multifasta, args.cov, args.pident,\
         args.e_value, args.graph = ui.friendly_user_interfase()
 
+    if args.database and not args.genBank and not args.multifasta:
+        print('\nOriginal subject sequences through genBank \
+               or FASTA file must be provided\n')
+        exit(1)
+    if args.dedup and args.database:
+        print('\n-dedup only applies to databases built by this run, \
+               not to a given -database\n')
+        exit(1)
+    if args.resume and not os.path.isdir(args.resume):
+        print('\nResults directory to resume not found: '+args.resume+'\n')
+        exit(1)
+    import file_handler as fh
+
     # Running time starts after getting all input parameters
     time0 = time.time()
     now = str(datetime.now()).rsplit('.', 1)[0]\
@@ -77,16 +137,34 @@ def main():
                              .replace(':', '.')
 
 
-    if args.results_dir: results = os.path.abspath(args.results_dir)\
-                                          .rstrip('/')+'/'
+    if args.resume:
+        results = os.path.abspath(args.resume).rstrip('/')+'/'
+    elif args.results_dir: results = os.path.abspath(args.results_dir)\
+                                            .rstrip('/')+'/'
     else: results = 'results/'+now+'/'
     os.makedirs(results, exist_ok=True) # Recursively create results directory
+    # Stages are skipped when resuming if inputs and parameters are unchanged
+    resume = bool(args.resume)
 
     # Boolean to check whether previous step(s) have been computed
     toBeContinued = False
     logfile = results+'_log'
-    open(logfile, 'w').close() # Create logfile
+    if not resume: open(logfile, 'w').close() # Create logfile
+    metrics.start(output_dir=results, profile=args.profile)
     blast_output = results+'_blast_output'
+    # Blast output with sequences: hit table and distinct sequences
+    # (see fh.write_hits), exported to blast_output.tsv if export_tsv
+    hit_tables = [results+fh.HITS_FILE, results+fh.SEQS_FILE]
+    # Subject FASTA indexes keyed by content, shared by every run
+    # (beside database cache if given)
+    if args.db_cache:
+        index_cache = os.path.dirname(os.path.abspath(args.db_cache))\
+                      +'/fasta_indexes'
+    else: index_cache = fh.INDEX_CACHE
+    # Files subject multifasta is built from: index found without hashing
+    # it while they are unchanged
+    index_sources = fh.list_all(args.genBank or args.multifasta)
+    exported = [blast_output+'.tsv'] if args.export_tsv else []
 
     # Create a single multifasta and tsv file containing all queries from input
     # (single, several files or directory)
@@ -94,11 +172,15 @@ def main():
         query = results+os.path.basename(args.query[0]).rsplit('.', 1)[0]
     else:
         query = results+'query'
-    fh.merge_files(
-                   input_files=args.query,
-                   output_dir=results,
-                   output_filename=query+'.fasta'
-                   )
+    stage = dict(inputs=args.query, outputs=[query+'.fasta'],
+                 params={}, output_dir=results)
+    if pipe.is_stale('queries', resume=resume, **stage):
+        fh.merge_files(
+                       input_files=args.query,
+                       output_dir=results,
+                       output_filename=query+'.fasta'
+                       )
+        pipe.checkpoint('queries', resume=resume, **stage)
 
     # Create directory for each query, inside results
     fh.fasta2dirs(fasta_file=query+'.fasta', output_dir=results)
@@ -111,20 +193,21 @@ def main():
                                      + os.path.basename(args.multifasta[0])
         else:
             gb_multifasta_filename = results+'genBank_multifasta.fasta'
-        fh.merge_files(
-                       input_files=args.multifasta,
-                       output_dir=results,
-                       output_filename=gb_multifasta_filename
-                       )
+        stage = dict(inputs=args.multifasta,
+                     outputs=[gb_multifasta_filename],
+                     params={}, output_dir=results)
+        if pipe.is_stale('subjects', resume=resume, **stage):
+            fh.merge_files(
+                           input_files=args.multifasta,
+                           output_dir=results,
+                           output_filename=gb_multifasta_filename
+                           )
+            pipe.checkpoint('subjects', resume=resume, **stage)
     else:
         gb_multifasta_filename = results+'genBank_multifasta.fasta'
 
     if args.database:
         database = args.database
-        if not args.genBank and not args.multifasta:
-            print('\nOriginal subject sequences through genBank \
-                   or FASTA file must be provided\n')
-            exit(1)
     else:
         database = results+'database/genBank'
 
@@ -136,93 +219,289 @@ def main():
     if args.genBank:
         # Generate combined multifasta with all parsed GenBank files
         print("Generating multifasta from GenBank file(s)")
-        gbp.parse_gbs(
-                      genBanks=args.genBank,
-                      sequence_type=SEQ_TYPE,
-                      output_dir=results,
-                      output_filename=gb_multifasta_filename
-                      )
+        import genbank_parser as gbp
+        stage = dict(inputs=args.genBank,
+                     outputs=[gb_multifasta_filename,
+                              results+'_genBank_info.*'],
+                     params={'sequence_type': SEQ_TYPE,
+                             'export_tsv': args.export_tsv},
+                     output_dir=results)
+        if pipe.is_stale('genBank', resume=resume, **stage):
+            with metrics.measure('genBank') as counts:
+                counts['files'], counts['cds'] = gbp.parse_gbs(
+                                    genBanks=args.genBank,
+                                    sequence_type=SEQ_TYPE,
+                                    output_dir=results,
+                                    output_filename=gb_multifasta_filename,
+                                    workers=args.workers,
+                                    export_tsv=args.export_tsv
+                                    )
+            pipe.checkpoint('genBank', resume=resume, **stage)
         toBeContinued = True
 
-    if args.multifasta or toBeContinued:
+    # Representative -> member ids of identical subject sequences
+    # (only if the database is built from deduplicated subjects)
+    members_filename = None
+    if not args.database and (args.multifasta or toBeContinued):
+        db_multifasta = gb_multifasta_filename
+        if args.dedup:
+            print("Collapsing identical subject sequences...")
+            db_multifasta = results+'_dedup.fasta'
+            members_filename = results+'_dedup_members.json'
+            stage = dict(inputs=[gb_multifasta_filename],
+                         outputs=[db_multifasta, members_filename],
+                         params={}, output_dir=results)
+            if pipe.is_stale('dedup', resume=resume, **stage):
+                with metrics.measure('dedup') as counts:
+                    counts['sequences'],\
+                    counts['representatives'],\
+                    counts['residues'] = bl.dedup_multifasta(
+                                           multifasta=gb_multifasta_filename,
+                                           output_filename=db_multifasta,
+                                           members_filename=members_filename
+                                           )
+                print('  {sequences} sequences, {representatives} distinct'
+                      .format(**counts))
+                pipe.checkpoint('dedup', resume=resume, **stage)
         # Generate database from created multifasta
         print("Generating database...")
-        bl.multifasta2database(
-                               multifasta=gb_multifasta_filename,
-                               sequence_type=SEQ_TYPE,
-                               output_dir=results,
-                               output_filename=database,
-                               log=logfile
-                               )
+        if args.db_cache:
+            if args.db_cache_size: max_size = args.db_cache_size * 1024**3
+            else: max_size = None
+            with metrics.measure('database'):
+                database = bl.cached_database(
+                                          multifasta=db_multifasta,
+                                          sequence_type=SEQ_TYPE,
+                                          cache_dir=args.db_cache,
+                                          max_size=max_size,
+                                          log=logfile
+                                          )
+        else:
+            stage = dict(inputs=[db_multifasta],
+                         outputs=[database+'.*'],
+                         params={'sequence_type': SEQ_TYPE},
+                         output_dir=results)
+            if pipe.is_stale('database', resume=resume, **stage):
+                with metrics.measure('database'):
+                    bl.multifasta2database(
+                                           multifasta=db_multifasta,
+                                           sequence_type=SEQ_TYPE,
+                                           output_dir=results,
+                                           output_filename=database,
+                                           log=logfile
+                                           )
+                pipe.checkpoint('database', resume=resume, **stage)
         toBeContinued = True
 
-    # Perform blastp
-    print("Performing blast analysis...")
-    bl.blast_compute(
-                     query_fasta=query+'.fasta',
-                     database_path=database,
-                     sequence_type=SEQ_TYPE,
-                     e_value=e_value,
-                     cov_threshold=args.cov,
-                     pident_threshold=args.pident,
-                     output_dir=results,
-                     output_filename=blast_output,
-                     log=logfile
-                     )
-    # Include complete subject sequences in blast_output
-    bl.retrieve_seqs(
-                     query_fasta=query+'.fasta',
-                     subject_multifasta=gb_multifasta_filename,
-                     blast_output=blast_output+'.tsv',
-                     output_dir=results,
-                     output_filename=blast_output+'.tsv',
-                     remove_files=True
-                     )
-
-    # Include query_fasta and perform multiple alignment(s) using MUSCLE
-    print("Performing multiple alignment(s)...")
-    ms.compute_alignments(
-                          blast_output=blast_output+'.tsv',
-                          output_dir=results
-                          )
-
-    # Compute NJ tree using MUSCLE
-    print("Computing N-J phylogenetic tree(s)...")
-    ms.compute_trees(
-                     blast_output=blast_output+'.tsv',
-                     output_dir=results,
-                     output_filename="NJ.phy",
-                     log=logfile
-                     )
-
-    # Map domains and store them
-    print("Extracting ProSite domains...")
-    proparse.find_domains(
-                          blast_output=blast_output+'.tsv',
-                          output_dir=results,
-                          summary=True
-                          )
+    # Blast output with sequences, handed in memory from stage to stage
+    # (only read back from hit tables if its stage was already done)
+    hits = None
+    dedup_inputs = [members_filename] if members_filename else []
+    import prosite_parser as proparse
+    if args.stream:
+        # Chain of every query started as soon as its blast hits are found
+        print("Performing blast analysis, multiple alignment(s), "
+              "N-J phylogenetic tree(s) and ProSite domain extraction "
+              "of each query...")
+        outputs = hit_tables+exported+[results+'*/unaligned.fasta',
+                                       results+'*/alignment.fasta',
+                                       results+'*/NJ.phy',
+                                       results+'*/domains/_domains.tsv',
+                                       results+'*/domains/*_dominfo.txt']
+        if args.graph:
+            outputs.extend([results+'*/blast.png',
+                            results+'*/domains/*_domains.png'])
+        stage = dict(inputs=[query+'.fasta', gb_multifasta_filename,
+                             database+'.*', proparse.PROSITE_DAT,
+                             proparse.PROSITE_DOC]+dedup_inputs,
+                     outputs=outputs,
+                     params={'sequence_type': SEQ_TYPE, 'e_value': e_value,
+                             'cov': args.cov, 'pident': args.pident,
+                             'backend': args.tree_backend,
+                             'graph': args.graph,
+                             'max_figures': args.max_figures,
+                             'export_tsv': args.export_tsv},
+                     output_dir=results)
+        if pipe.is_stale('stream', resume=resume, **stage):
+            members, dbsize = bl.read_members(members_filename) \
+                              if members_filename else (None, None)
+            with metrics.measure('stream') as counts:
+                hits,\
+                counts['hits_read'],\
+                counts['hits'] = streaming.stream_queries(
+                                         query_fasta=query+'.fasta',
+                                         subject_multifasta=
+                                             gb_multifasta_filename,
+                                         database_path=database,
+                                         sequence_type=SEQ_TYPE,
+                                         e_value=e_value,
+                                         output_dir=results,
+                                         output_filename=blast_output,
+                                         cov_threshold=args.cov,
+                                         pident_threshold=args.pident,
+                                         log=logfile,
+                                         shards=args.blast_shards,
+                                         threads=args.blast_threads,
+                                         in_flight=args.stream,
+                                         tree_backend=args.tree_backend,
+                                         use_cache=not args.no_domain_cache,
+                                         graphs=args.graph,
+                                         max_figures=args.max_figures,
+                                         export_tsv=args.export_tsv,
+                                         members=members,
+                                         dbsize=dbsize,
+                                         index_cache=index_cache,
+                                         index_sources=index_sources
+                                         )
+                counts['queries'] = hits.qseqid.nunique()
+            pipe.checkpoint('stream', resume=resume, **stage)
+    else:
+        import muscle as ms
+        # Perform blastp
+        print("Performing blast analysis...")
+        # Subject sequences are retrieved in place: single stage with blast
+        stage = dict(inputs=[query+'.fasta', gb_multifasta_filename,
+                             database+'.*']+dedup_inputs,
+                     outputs=[results+'_blastp.tsv']+hit_tables+exported,
+                     params={'sequence_type': SEQ_TYPE, 'e_value': e_value,
+                             'cov': args.cov, 'pident': args.pident,
+                             'export_tsv': args.export_tsv},
+                     output_dir=results)
+        if pipe.is_stale('blast', resume=resume, **stage):
+            members, dbsize = bl.read_members(members_filename) \
+                              if members_filename else (None, None)
+            with metrics.measure('blast'):
+                with metrics.measure('blastp') as counts:
+                    counts['hits_read'], counts['hits'] = bl.blast_compute(
+                                             query_fasta=query+'.fasta',
+                                             database_path=database,
+                                             sequence_type=SEQ_TYPE,
+                                             e_value=e_value,
+                                             cov_threshold=args.cov,
+                                             pident_threshold=args.pident,
+                                             output_dir=results,
+                                             output_filename=results
+                                                             +'_blastp',
+                                             log=logfile,
+                                             shards=args.blast_shards,
+                                             threads=args.blast_threads,
+                                             members=members,
+                                             dbsize=dbsize
+                                             )
+                # Include complete subject sequences in blast output
+                with metrics.measure('retrieve_seqs') as counts:
+                    hits = bl.retrieve_seqs(
+                                     query_fasta=query+'.fasta',
+                                     subject_multifasta=gb_multifasta_filename,
+                                     blast_output=results+'_blastp.tsv',
+                                     output_dir=results,
+                                     output_filename=blast_output+'.tsv',
+                                     export_tsv=args.export_tsv,
+                                     index_cache=index_cache,
+                                     index_sources=index_sources
+                                     )
+                    counts['subjects'] = hits.sseqid.nunique()
+            pipe.checkpoint('blast', resume=resume, **stage)
+
+        # Include query_fasta, perform multiple alignment(s) and compute
+        # NJ tree(s) using MUSCLE
+        print("Performing multiple alignment(s) and "
+              "computing N-J phylogenetic tree(s)...")
+        if hits is None: hits = fh.read_hits(results)
+        stage = dict(inputs=hit_tables,
+                     outputs=[results+'*/unaligned.fasta',
+                              results+'*/alignment.fasta',
+                              results+'*/NJ.phy'],
+                     params={'backend': args.tree_backend},
+                     output_dir=results)
+        if pipe.is_stale('alignment', resume=resume, **stage):
+            # Alignments and trees run concurrently: their summed job times
+            # are reported along with the wall time of the whole step
+            with metrics.measure('alignment') as counts:
+                counts['queries'],\
+                counts['alignment_jobs_s'],\
+                counts['tree_jobs_s'] = ms.align_and_build_trees(
+                                             blast_output=hits,
+                                             output_dir=results,
+                                             output_filename="NJ.phy",
+                                             jobs=args.workers,
+                                             log=logfile,
+                                             backend=args.tree_backend
+                                             )
+            pipe.checkpoint('alignment', resume=resume, **stage)
+
+        # Map domains and store them
+        print("Extracting ProSite domains...")
+        stage = dict(inputs=hit_tables+[results+'*/unaligned.fasta',
+                                            proparse.PROSITE_DAT,
+                                            proparse.PROSITE_DOC],
+                     outputs=[results+'*/domains/_domains.tsv',
+                              results+'*/domains/*_dominfo.txt'],
+                     params={}, output_dir=results)
+        if pipe.is_stale('domains', resume=resume, **stage):
+            with metrics.measure('domains') as counts:
+                counts['queries'], counts['sequences'] = proparse.find_domains(
+                                             blast_output=hits,
+                                             output_dir=results,
+                                             summary=True,
+                                             workers=args.workers,
+                                             use_cache=not args.no_domain_cache
+                                             )
+            pipe.checkpoint('domains', resume=resume, **stage)
 
     # Merge blast output, genBank info and ProSite domains (only names)
     # into one tsv file
-    fh.merge_results(
-                     blast_output=blast_output+'.tsv',
-                     genBank_tsv=results+'_genBank_info.tsv',
-                     output_dir=results,
-                     output_filename='_merged.tsv',
-                     include_gb=args.genBank
-                     )
-
-    if args.graph:
+    if hits is None: hits = fh.read_hits(results)
+    stage = dict(inputs=hit_tables+[results+'_genBank_info.feather',
+                                        results+'*/domains/_domains.tsv'],
+                 outputs=[results+'_merged.tsv'],
+                 params={'include_gb': bool(args.genBank)},
+                 output_dir=results)
+    if pipe.is_stale('merge', resume=resume, **stage):
+        with metrics.measure('merge') as counts:
+            counts['rows'] = fh.merge_results(
+                                         blast_output=hits,
+                                         genBank_info=results
+                                                      +'_genBank_info.feather',
+                                         output_dir=results,
+                                         output_filename='_merged.tsv',
+                                         include_gb=args.genBank
+                                         )
+        pipe.checkpoint('merge', resume=resume, **stage)
+
+    # Graphs of every query already drawn in streaming mode
+    if args.graph and not args.stream:
         print("Creating and storing graphs...")
-        graph.blast_plot(
-                         blast_output=blast_output+'.tsv',
-                         output_dir=results
+        import graphication as graph
+        stage = dict(inputs=hit_tables+[results+'*/domains/_domains.tsv'],
+                     outputs=[results+'*/blast.png',
+                              results+'*/domains/*_domains.png'],
+                     params={'max_figures': args.max_figures},
+                     output_dir=results)
+        if pipe.is_stale('graph', resume=resume, **stage):
+            with metrics.measure('graph') as counts:
+                counts['blast_figures'],\
+                counts['blast_figures_unchanged'] = graph.blast_plot(
+                                         blast_output=hits,
+                                         output_dir=results,
+                                         workers=args.workers
+                                         )
+                counts['domain_figures'],\
+                counts['domain_figures_unchanged'] = graph.domain_plot(
+                                         blast_output=hits,
+                                         output_dir=results,
+                                         workers=args.workers,
+                                         max_figures=args.max_figures
+                                         )
+            pipe.checkpoint('graph', resume=resume, **stage)
+
+    # Per-step timing, memory and item counts
+    metrics.write_report(
+                         output_filename=results+'_metrics.json',
+                         command=sys.argv,
+                         resumed=resume,
+                         wall_s=round(time.time() - time0, 3)
                          )
-        graph.domain_plot(
-                          blast_output=blast_output+'.tsv',
-                          output_dir=results
-                          )
 
     # Ring bell to notify completion
     print("\nProcess COMPLETED")
@@ -0,0 +1,138 @@
+#!/usr/bin/env python
+import cProfile
+import json
+import os
+import resource
+import sys
+import time
+
+from contextlib import contextmanager
+
+# Measured steps (in completion order) and steps being measured
+# (with highest peak RSS seen so far within each one)
+_STEPS = []
+_RUNNING = []
+# Steps to profile and directory to store their profiles
+_PROFILE = set()
+_PROFILE_DIR = '.'
+
+
+def _scale():
+    """ Divisor of ru_maxrss to MB: kB on Linux, bytes on macOS """
+    return 1024**2 if sys.platform == 'darwin' else 1024
+
+
+def _children_peak_rss():
+    """ Peak RSS (MB) of largest finished child process so far """
+    return resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss / _scale()
+
+
+def _reset_peak_rss():
+    """ Reset peak RSS of this process to its current RSS (Linux). \
+        Return whether it could be reset """
+    try:
+        with open('/proc/self/clear_refs', 'w') as clear_refs:
+            clear_refs.write('5')
+        return True
+    except OSError:
+        return False
+
+
+def _peak_rss():
+    """ Peak RSS (MB) of this process since last reset (Linux VmHWM), \
+        or over its whole lifetime if it cannot be reset """
+    try:
+        with open('/proc/self/status', 'r') as status:
+            for line in status:
+                if line.startswith('VmHWM:'):
+                    return int(line.split()[1]) / 1024
+    except OSError:
+        pass
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / _scale()
+
+
+def _fold_peak_rss():
+    """ Account current peak RSS to every running step """
+    peak = _peak_rss()
+    for running in _RUNNING: running['peak'] = max(running['peak'], peak)
+
+
+def start(output_dir, profile=()):
+    """ Start new report. Steps named in profile are run under cProfile \
+        and their stats stored as output_dir/_profile_<step>.prof """
+    global _PROFILE_DIR
+    del _STEPS[:]
+    _PROFILE.clear()
+    _PROFILE.update(profile)
+    _PROFILE_DIR = output_dir
+
+
+@contextmanager
+def measure(step):
+    """ Measure wall time, CPU time (including finished child processes) \
+        and peak RSS of the enclosed step. Yields dict where item \
+        counts of the step (e.g. records, hits, figures) can be stored.
+        Steps measured within another one are recorded as its substeps.
+        Peak RSS of the step itself (peak_rss_mb) needs the peak \
+        to be reset at step start (Linux); otherwise the peak of \
+        the process so far is recorded as process_peak_rss_mb. \
+        Largest child process peak is only known (children_peak_rss_mb) \
+        if it exceeded those of earlier steps: rusage only keeps \
+        the maximum over all finished children """
+    counts = {}
+    parent = _RUNNING[-1]['step'] if _RUNNING else None
+    # Peak so far belongs to enclosing steps, reset for this one
+    _fold_peak_rss()
+    per_step = _reset_peak_rss()
+    running = dict(step=step, peak=_peak_rss())
+    _RUNNING.append(running)
+    children_rss0 = _children_peak_rss()
+    profiler = cProfile.Profile() if step in _PROFILE else None
+    times0 = os.times()
+    time0 = time.perf_counter()
+    if profiler: profiler.enable()
+    try:
+        yield counts
+    finally:
+        if profiler: profiler.disable()
+        wall = time.perf_counter() - time0
+        times1 = os.times()
+        _fold_peak_rss()
+        _RUNNING.pop()
+        children_rss = _children_peak_rss()
+        record = dict(step=step, parent=parent, wall_s=round(wall, 3),
+                      cpu_s=round(times1.user - times0.user
+                                  + times1.system - times0.system, 3),
+                      children_cpu_s=round(
+                                 times1.children_user - times0.children_user
+                                 + times1.children_system
+                                 - times0.children_system, 3),
+                      counts=counts)
+        if per_step: record['peak_rss_mb'] = round(running['peak'], 1)
+        else: record['process_peak_rss_mb'] = round(running['peak'], 1)
+        record['children_peak_rss_mb'] = round(children_rss, 1) \
+                                         if children_rss > children_rss0 \
+                                         else None
+        for item, count in counts.items():
+            if isinstance(count, float): counts[item] = round(count, 3)
+        # Throughput of every item count
+        per_s = {item: round(count / wall, 2)
+                 for item, count in counts.items()
+                 if isinstance(count, int) and wall > 0}
+        if per_s: record['per_s'] = per_s
+        if profiler:
+            record['profile'] = _PROFILE_DIR.rstrip('/')+'/'\
+                                +'_profile_'+step+'.prof'
+            profiler.dump_stats(record['profile'])
+        _STEPS.append(record)
+
+
+def steps():
+    """ Return measured steps of current report """
+    return list(_STEPS)
+
+
+def write_report(output_filename, **info):
+    """ Store measured steps (and given run info) as JSON """
+    with open(output_filename, 'w') as report:
+        json.dump(dict(info, steps=_STEPS), report, indent=1)
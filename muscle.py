@@ -2,11 +2,32 @@
 
 import os
 import sys
+import threading
+import time
 
-from subprocess import call, PIPE, Popen
+from concurrent.futures import ThreadPoolExecutor
+from subprocess import call, run, PIPE, Popen
+from Bio.SeqIO.FastaIO import SimpleFastaParser
 import pandas as pd
 
 import file_handler as fh
+import neighbor_joining as nj
+
+# Serializes appends of concurrent jobs to the log file
+_LOG_LOCK = threading.Lock()
+
+
+def _alignment_command(multifasta, output_filename, log):
+    """ MUSCLE command computing multiple alignment """
+    return ['muscle', '-in', multifasta, '-out', output_filename,
+            '-verbose', '-loga', log]
+
+
+def _tree_command(alignment, output_filename, log):
+    """ MUSCLE command computing Neighbor-Joining tree """
+    return ['muscle', '-maketree', '-in', alignment, '-out', output_filename,
+            '-quiet', '-loga', log, '-cluster', 'neighborjoining']
+
 
 def multiple_alignment(multifasta, query=None,
                        output_filename="alignment.fasta", log='/dev/null'):
@@ -18,47 +39,134 @@ def multiple_alignment(multifasta, query=None,
             multifasta_file.write('>'+query[0]+'\n')
             multifasta_file.write(query[1]+'\n')
     call(
-        ['muscle', '-in', multifasta, '-out', output_filename,
-         '-verbose', '-loga', log], stderr=open(log, 'a+')
+        _alignment_command(multifasta, output_filename, log),
+        stderr=open(log, 'a+')
         )
     return
 
 
 def compute_alignments(blast_output, output_dir):
     """ Compute multiple alignment(s) \
-        for each of the queries in blast_output.tsv """
-    df = pd.read_csv(blast_output, delimiter='\t')
+        for each of the queries in blast_output \
+        (tsv file or table in memory, see fh.read_blast) """
+    df = fh.read_blast(blast_output)
+    # Create FASTA file containing hits and query for each query
+    fh.tsv2fasta(tsv_file=df, output_dir=output_dir,
+                 separate_dirs=True, include_query=True)
     for qid in pd.unique(df.qseqid):
-        data = df[df.qseqid == qid].reset_index(drop=True)
         query_dir = output_dir.rstrip('/')+'/'+qid+'/'
-        # Create FASTA file containing hits for each query
-        fh.tsv2fasta(tsv_file=blast_output, output_dir=output_dir,
-                     separate_dirs=True)
         multiple_alignment(
                            multifasta=query_dir+'unaligned.fasta',
-                           query=(qid, data.qseq[0]),
                            output_filename=query_dir+'alignment.fasta'
                           )
     return
 
 
-def compute_NJtree(alignment, output_filename="NJ.phy", log='/dev/null'):
-    """ Compute Neighbor-Joining tree using MUSCLE """
+def compute_NJtree(alignment, output_filename="NJ.phy", log='/dev/null',
+                   backend='muscle'):
+    """ Compute Neighbor-Joining tree using MUSCLE \
+        or in-process (backend='numpy', see neighbor_joining) """
+    if backend == 'numpy':
+        nj.compute_tree(alignment, output_filename)
+        return
     call(
-         ['muscle', '-maketree', '-in', alignment, '-out', output_filename,
-         '-quiet', '-loga', log, '-cluster', 'neighborjoining'],
+         _tree_command(alignment, output_filename, log),
          stderr=open(log, 'a+')
         )
     return
 
 
 def compute_trees(blast_output, output_dir, output_filename="NJ.phy",
-                  log='/dev/null'):
-    """ Compute Neighbor-Joining tree for each query in blast_output.tsv """
-    df = pd.read_csv(blast_output, delimiter='\t')
-    for idx in range(len(df.qseqid)):
-        qid = df.qseqid[idx]
+                  log='/dev/null', backend='muscle'):
+    """ Compute Neighbor-Joining tree for each query in blast_output \
+        (tsv file or table in memory, see fh.read_blast) """
+    df = fh.read_blast(blast_output, columns=['qseqid'])
+    for qid in pd.unique(df.qseqid):
         query_dir = output_dir.rstrip('/')+'/'+qid+'/'
         compute_NJtree(alignment=query_dir+'alignment.fasta',
-                       output_filename=query_dir+output_filename, log=log)
+                       output_filename=query_dir+output_filename, log=log,
+                       backend=backend)
     return
+
+
+def _run_job(command, job_log, log, log_lock):
+    """ Run external tool with its own job_log (MUSCLE -loga). \
+        Captured output and job_log are appended to log in one block """
+    result = run(command, stdout=PIPE, stderr=PIPE)
+    with log_lock:
+        with open(log, 'ab') as log_file:
+            if os.path.exists(job_log):
+                with open(job_log, 'rb') as job_log_file:
+                    log_file.write(job_log_file.read())
+            log_file.write(result.stdout)
+            log_file.write(result.stderr)
+    if os.path.exists(job_log): os.remove(job_log)
+    return result.returncode
+
+
+def align_and_build_tree(query_dir, output_filename="NJ.phy",
+                         log='/dev/null', log_lock=None, backend='muscle'):
+    """ Compute multiple alignment of query_dir/unaligned.fasta \
+        and its Neighbor-Joining tree (see compute_NJtree).
+        Output of concurrent jobs is appended to log under log_lock.
+        Return time (s) spent in alignment and in tree """
+    if log_lock is None: log_lock = _LOG_LOCK
+    time0 = time.time()
+    _run_job(_alignment_command(query_dir+'unaligned.fasta',
+                                query_dir+'alignment.fasta',
+                                query_dir+'_alignment.log'),
+             query_dir+'_alignment.log', log, log_lock)
+    time1 = time.time()
+    if backend == 'numpy':
+        nj.compute_tree(query_dir+'alignment.fasta',
+                        query_dir+output_filename)
+    else:
+        _run_job(_tree_command(query_dir+'alignment.fasta',
+                               query_dir+output_filename,
+                               query_dir+'_tree.log'),
+                 query_dir+'_tree.log', log, log_lock)
+    return time1 - time0, time.time() - time1
+
+
+def align_and_build_trees(blast_output, output_dir, output_filename="NJ.phy",
+                          jobs=1, log='/dev/null', backend='muscle'):
+    """ Compute multiple alignment and Neighbor-Joining tree \
+        (MUSCLE or in-process, see compute_NJtree) for each query \
+        in blast_output (tsv file or table in memory, see fh.read_blast), \
+        running up to jobs MUSCLE processes at once. \
+        Largest queries (input residues) are started first \
+        and each tree as soon as its alignment is done.
+        Return number of queries and total time (s) spent \
+        in alignments and in trees """
+    df = fh.read_blast(blast_output)
+    # Create FASTA file containing hits and query for each query
+    fh.tsv2fasta(tsv_file=df, output_dir=output_dir,
+                 separate_dirs=True, include_query=True)
+    query_dirs = {}
+    residues = {}
+    for qid in pd.unique(df.qseqid):
+        query_dirs[qid] = output_dir.rstrip('/')+'/'+qid+'/'
+        with open(query_dirs[qid]+'unaligned.fasta', 'r') as fasta:
+            residues[qid] = sum(len(sequence) for dummy_title, sequence
+                                in SimpleFastaParser(fasta))
+    log_lock = _LOG_LOCK
+    finished = []
+    elapsed = {'alignment': 0., 'tree': 0.}
+
+    def align_and_tree(qid):
+        alignment_time, tree_time = align_and_build_tree(
+                                        query_dirs[qid], output_filename,
+                                        log, log_lock, backend)
+        with log_lock:
+            finished.append(qid)
+            elapsed['alignment'] += alignment_time
+            elapsed['tree'] += tree_time
+            print('  [{}/{}] {}: alignment {:.1f}s, tree {:.1f}s'.format(
+                  len(finished), len(query_dirs), qid,
+                  alignment_time, tree_time))
+
+    with ThreadPoolExecutor(max_workers=max(1, jobs)) as pool:
+        futures = [pool.submit(align_and_tree, qid)
+                   for qid in sorted(query_dirs, key=lambda qid: -residues[qid])]
+        for future in futures: future.result()
+    return len(query_dirs), elapsed['alignment'], elapsed['tree']
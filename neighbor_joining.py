@@ -0,0 +1,85 @@
+#!/usr/bin/env python
+
+import numpy as np
+from Bio.SeqIO.FastaIO import SimpleFastaParser
+
+# Distance given to sequence pairs too divergent for Kimura correction
+MAX_DISTANCE = 10.0
+
+
+def read_alignment(alignment):
+    """ Return sequence ids and alignment (FASTA) as 2D array of bytes """
+    ids = []
+    seqs = []
+    with open(alignment, 'r') as fasta:
+        for title, sequence in SimpleFastaParser(fasta):
+            ids.append(title.split(None, 1)[0])
+            seqs.append(sequence.upper().encode())
+    length = max([len(seq) for seq in seqs] or [0])
+    msa = np.full((len(seqs), length), ord('-'), dtype=np.uint8)
+    for idx, seq in enumerate(seqs):
+        msa[idx, :len(seq)] = np.frombuffer(seq, dtype=np.uint8)
+    return ids, msa
+
+
+def distance_matrix(msa):
+    """ Return pairwise Kimura protein distances between aligned sequences.
+        Identities and compared (gap-free) positions of all pairs \
+        are obtained through matrix products """
+    residues = (msa != ord('-')) & (msa != ord('.'))
+    valid = residues.astype(np.float32)
+    compared = valid @ valid.T
+    identical = np.zeros(compared.shape, dtype=np.float32)
+    for residue in np.unique(msa[residues]):
+        matches = (msa == residue).astype(np.float32)
+        identical += matches @ matches.T
+    with np.errstate(divide='ignore', invalid='ignore'):
+        p = np.where(compared > 0, 1 - identical / compared, 1.0)
+    kimura = 1 - p - 0.2 * p**2
+    saturated = kimura <= np.exp(-MAX_DISTANCE)
+    dist = np.maximum(-np.log(np.where(saturated, 1.0, kimura)), 0)
+    dist[saturated] = MAX_DISTANCE
+    np.fill_diagonal(dist, 0)
+    return dist
+
+
+def neighbor_joining(ids, dist):
+    """ Return Neighbor-Joining tree (Newick) from distance matrix.
+        Memory is O(n^2): joined nodes reuse the row of one child """
+    dist = np.array(dist, dtype=np.float64)
+    nodes = list(ids)
+    active = np.ones(len(nodes), dtype=bool)
+    if len(nodes) == 1: return nodes[0]+';'
+    while active.sum() > 2:
+        idx = np.flatnonzero(active)
+        sub = dist[np.ix_(idx, idx)]
+        n = len(idx)
+        totals = sub.sum(axis=1)
+        q = (n - 2) * sub - totals[:, None] - totals[None, :]
+        np.fill_diagonal(q, np.inf)
+        i, j = np.unravel_index(np.argmin(q), q.shape)
+        length_i = sub[i, j] / 2 + (totals[i] - totals[j]) / (2 * (n - 2))
+        length_j = sub[i, j] - length_i
+        node_i, node_j = idx[i], idx[j]
+        nodes[node_i] = '({}:{:.5f},{}:{:.5f})'.format(
+                        nodes[node_i], max(length_i, 0),
+                        nodes[node_j], max(length_j, 0))
+        # Distances from joined node to the remaining ones
+        joined = (sub[i] + sub[j] - sub[i, j]) / 2
+        dist[node_i, idx] = joined
+        dist[idx, node_i] = joined
+        dist[node_i, node_i] = 0
+        active[node_j] = False
+    node_i, node_j = np.flatnonzero(active)
+    length = max(dist[node_i, node_j], 0) / 2
+    return '({}:{:.5f},{}:{:.5f});'.format(nodes[node_i], length,
+                                           nodes[node_j], length)
+
+
+def compute_tree(alignment, output_filename="NJ.phy"):
+    """ Compute Neighbor-Joining tree of alignment (FASTA) \
+        and store it in Newick format """
+    ids, msa = read_alignment(alignment)
+    with open(output_filename, 'w') as output_file:
+        output_file.write(neighbor_joining(ids, distance_matrix(msa))+'\n')
+    return
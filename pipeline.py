@@ -0,0 +1,119 @@
+#!/usr/bin/env python
+import glob
+import json
+import os
+
+# Stage manifests are stored in this directory, inside results
+MANIFEST_DIR = '_manifests'
+MANIFEST_VERSION = 1
+
+
+def _expand(patterns):
+    """ Sorted list of files (absolute paths) matching given paths \
+        or glob patterns. Directories are listed recursively \
+        (hidden files excluded) """
+    files = set()
+    for pattern in patterns:
+        for path in glob.glob(pattern):
+            if os.path.isdir(path):
+                for root, dirs, filenames in os.walk(path):
+                    dirs[:] = [d for d in dirs if not d.startswith('.')]
+                    files.update(os.path.join(root, filename)
+                                 for filename in filenames
+                                 if not filename.startswith('.'))
+            else:
+                files.add(path)
+    return sorted(set(os.path.abspath(filename) for filename in files))
+
+
+def _signatures(patterns, recorded={}, hash_changed=False):
+    """ Return {file: [size, mtime_ns(, sha256)]} of files matching \
+        patterns. Hash recorded for a file with same size and mtime \
+        is kept; other files are only hashed if hash_changed """
+    signatures = {}
+    for filename in _expand(patterns):
+        stat = os.stat(filename)
+        signature = [stat.st_size, stat.st_mtime_ns]
+        known = recorded.get(filename)
+        if known and known[:2] == signature:
+            signatures[filename] = known
+        elif hash_changed:
+            import file_handler as fh
+            signatures[filename] = signature + [fh.file_hash(filename)]
+        else:
+            signatures[filename] = signature
+    return signatures
+
+
+def _unchanged(recorded, patterns):
+    """ Whether files matching patterns are the recorded ones, \
+        with same size and mtime or (if only mtime differs and \
+        a hash was recorded) the same content """
+    import file_handler as fh
+    files = _expand(patterns)
+    if files != sorted(recorded): return False
+    for filename in files:
+        stat = os.stat(filename)
+        known = recorded[filename]
+        if known[:2] == [stat.st_size, stat.st_mtime_ns]: continue
+        # Hashed lazily: only touched files of same size
+        if known[0] != stat.st_size or len(known) < 3 \
+           or fh.file_hash(filename) != known[2]:
+            return False
+    return True
+
+
+def _manifest_file(stage, output_dir):
+    return output_dir.rstrip('/')+'/'+MANIFEST_DIR+'/'+stage+'.json'
+
+
+def _read_manifest(stage, output_dir):
+    """ Return manifest of stage (None if missing or unreadable) """
+    try:
+        with open(_manifest_file(stage, output_dir), 'r') as handle:
+            manifest = json.load(handle)
+        if manifest['version'] != MANIFEST_VERSION: return None
+        return manifest
+    except (OSError, ValueError, KeyError):
+        return None
+
+
+def is_stale(stage, inputs, outputs, params, output_dir, resume=False):
+    """ Whether stage must be run: always unless resuming. When resuming, \
+        only if its inputs, parameters or outputs changed since \
+        its manifest was written (or stage never completed). \
+        Files are compared by size and mtime, and by content \
+        only if just their mtime changed and their hash was recorded """
+    if not resume: return True
+    manifest = _read_manifest(stage, output_dir)
+    if manifest is not None \
+       and manifest['params'] == json.loads(json.dumps(params)) \
+       and _unchanged(manifest['inputs'], inputs) \
+       and _unchanged(manifest['outputs'], outputs):
+        print('  {}: up to date, skipped'.format(stage))
+        return False
+    return True
+
+
+def checkpoint(stage, inputs, outputs, params, output_dir, resume=False):
+    """ Write manifest of completed stage: size and mtime of its inputs \
+        and outputs (files or glob patterns) and its parameters.
+        Files are only hashed when resuming, if they changed since \
+        last manifest, so that a later resume can tell rewritten files \
+        with the same content apart (see is_stale). Normal runs \
+        never hash (inputs may be large, e.g. a given database) """
+    manifest = _read_manifest(stage, output_dir) or {}
+    manifest = dict(version=MANIFEST_VERSION, stage=stage,
+                    params=params,
+                    inputs=_signatures(inputs, manifest.get('inputs', {}),
+                                       hash_changed=resume),
+                    outputs=_signatures(outputs,
+                                        manifest.get('outputs', {}),
+                                        hash_changed=resume))
+    manifest_file = _manifest_file(stage, output_dir)
+    os.makedirs(os.path.dirname(manifest_file), exist_ok=True)
+    # Write to temporary file first: a partial manifest is never valid
+    tmp_file = manifest_file+'.tmp'
+    with open(tmp_file, 'w') as handle:
+        json.dump(manifest, handle, indent=1, sort_keys=True)
+    os.replace(tmp_file, manifest_file)
@@ -1,19 +1,35 @@
 #!/usr/bin/env python
 
+import hashlib
+import io
+import json
+import mmap
 import os
+import pickle
 import re
+import sqlite3
+import time
+from concurrent.futures import ProcessPoolExecutor
 
 from Bio.ExPASy import Prosite,Prodoc
 from Bio.SeqIO.FastaIO import SimpleFastaParser
 import numpy as np
 import pandas as pd
 
+import file_handler as fh
 
-def dat_parser(sequence,
-               fields=["name", "accession", "description", "pattern"]):
-    """ Finds domain hits from prosite.dat in input sequence """
-    hits = []
-    pattern_replacements = {'-' : '',
+
+PROSITE_DAT = 'prosite_files/prosite.dat'
+PROSITE_DOC = 'prosite_files/prosite.doc'
+# Persistent domain results, by sequence and ProSite release
+DOMAIN_CACHE = 'prosite_files/domain_cache.sqlite'
+# Maximum number of sequences kept in domain cache (LRU eviction)
+DOMAIN_CACHE_SIZE = 1000000
+# Bump whenever the layout of the pickled indexes changes
+INDEX_VERSION = 1
+
+# Transform ProSite patterns to regular expressions readable by re module
+PATTERN_REPLACEMENTS = {'-' : '',
                         '{' : '[^', # {X} = [^X]
                         '}' : ']',
                         '(' : '{', # (from, to) = {from, to}
@@ -23,48 +39,267 @@ def dat_parser(sequence,
                         '<' : '^', # < = N-terminal
                         '>' : '$' # > = C-terminal
                         }
-    with open("prosite_files/prosite.dat", "r") as handle:
-        records = Prosite.parse(handle)
-        for record in records:
-            pattern = record.pattern.strip('.')
-            # Transform ProSite patterns
-            # to regular expressions readable by re module
-            for pat, repl in pattern_replacements.items():
-                pattern = pattern.replace(pat, repl)
-            if pattern != "" and re.search(pattern, sequence):
-                hits.append([record.name, record.pdoc,
-                             record.description, pattern])
-    return hits
-
-
-def doc_parser(accession):
-    """ Returns information on domain with input accession number """
-    with open("prosite_files/prosite.doc") as handle:
-        records = Prodoc.parse(handle)
-        for record in records:
-            if accession == record.accession:
-                return record.text
 
+# Longest literal k-mer used to prefilter patterns before regex evaluation
+MAX_ANCHOR = 4
+# Number of subject sequences sent at once to each domain worker
+BATCH_SIZE = 64
+DOMAIN_COLUMNS = ['name', 'accession', 'description',
+                  'pattern', 'start', 'end', 'midpoint']
+
+# Pattern indexes already loaded in this process, by prosite.dat path
+_PATTERN_INDEX = {}
+# Scanners built in this process, by prosite.dat path
+_SCANNER = {}
+# prosite.doc (offset index, mmap) already opened in this process, by path
+_DOC_INDEX = {}
+# Documentation texts already read in this run, by (prosite.doc, accession)
+_DOC_TEXT = {}
+
+
+def prosite2regex(pattern):
+    """ Translate ProSite pattern into regular expression """
+    pattern = pattern.strip('.')
+    for pat, repl in PATTERN_REPLACEMENTS.items():
+        pattern = pattern.replace(pat, repl)
+    return pattern
+
+
+def _load_index(source, index_file, build):
+    """ Load pickled index of source file from index_file.
+        Index is rebuilt through build(source) (and stored) if missing, \
+        outdated or if source changed (size/mtime and sha256 checked) """
+    stat = os.stat(source)
+    signature = (stat.st_size, stat.st_mtime_ns)
+    index = None
+    if os.path.exists(index_file):
+        try:
+            with open(index_file, 'rb') as handle:
+                index = pickle.load(handle)
+            if index['version'] != INDEX_VERSION: index = None
+        except Exception:
+            index = None
+    store = False
+    if index is not None and index['signature'] != signature:
+        # Touched but possibly unchanged file: only content counts
+        if index['sha256'] == fh.file_hash(source):
+            index['signature'] = signature
+            store = True
+        else:
+            index = None
+    if index is None:
+        index = dict(version=INDEX_VERSION, signature=signature,
+                     sha256=fh.file_hash(source), data=build(source))
+        store = True
+    if store:
+        # Write to temporary file first to avoid exposing partial indexes
+        tmp_file = '{}.{}.tmp'.format(index_file, os.getpid())
+        try:
+            with open(tmp_file, 'wb') as handle:
+                pickle.dump(index, handle, protocol=pickle.HIGHEST_PROTOCOL)
+            os.replace(tmp_file, index_file)
+        except OSError:
+            # Read-only ProSite directory: keep index in memory only
+            if os.path.exists(tmp_file): os.remove(tmp_file)
+    return index['data']
+
+
+def _build_pattern_index(dat_file):
+    """ Parse prosite.dat and return list of \
+        (name, accession, description, pattern, compiled pattern) \
+        for every record with a ProSite pattern """
+    patterns = []
+    with open(dat_file, 'r') as handle:
+        for record in Prosite.parse(handle):
+            pattern = prosite2regex(record.pattern)
+            if pattern != "":
+                patterns.append((record.name, record.pdoc,
+                                 record.description, pattern,
+                                 re.compile(pattern)))
+    return patterns
+
+
+def load_patterns(dat_file=None):
+    """ Return ProSite pattern index (see _build_pattern_index). \
+        Cached on disk next to dat_file and loaded once per process """
+    if dat_file is None: dat_file = PROSITE_DAT
+    if dat_file not in _PATTERN_INDEX:
+        _PATTERN_INDEX[dat_file] = _load_index(dat_file, dat_file+'.idx',
+                                               _build_pattern_index)
+    return _PATTERN_INDEX[dat_file]
+
+
+def prosite_release(dat_file=None):
+    """ Return ProSite release stated in prosite.dat header \
+        (sha256 of the file if not stated) """
+    if dat_file is None: dat_file = PROSITE_DAT
+    with open(dat_file, 'r') as handle:
+        for line in handle:
+            if line.startswith('//'): break
+            match = re.search(r'Release (\S+)', line)
+            if match: return match.group(1)
+    return fh.file_hash(dat_file)
+
+
+def _literal_runs(pattern):
+    """ Return literal residue runs that every match of translated \
+        ProSite pattern must contain, or None if pattern is not understood """
+    runs = ['']
+    idx = 0
+    while idx < len(pattern):
+        char = pattern[idx]
+        if char == '[':
+            idx = pattern.index(']', idx) + 1
+            literal = None
+        elif char in '.^$':
+            idx += 1
+            literal = None
+        elif char.isalpha() and char.isupper():
+            idx += 1
+            literal = char
+        else:
+            return None
+        minimum = maximum = 1
+        if idx < len(pattern) and pattern[idx] == '{':
+            end = pattern.index('}', idx)
+            bounds = pattern[idx+1:end].split(',')
+            minimum, maximum = int(bounds[0]), int(bounds[-1])
+            idx = end + 1
+        if literal is None or minimum == 0:
+            runs.append('')
+        elif minimum == maximum:
+            runs[-1] += literal * minimum
+        else:
+            # Variable repetition: only its mandatory part is contiguous
+            # with the previous and with the following residues
+            runs[-1] += literal * minimum
+            runs.append(literal * minimum)
+    return [run for run in runs if run]
+
+
+def build_scanner(patterns):
+    """ Build multi-pattern scanner over pattern index: \
+        patterns are indexed by their longest mandatory literal k-mer \
+        (up to MAX_ANCHOR residues); patterns without one are always tried """
+    kmers = {}
+    unanchored = []
+    for pattern_id, pattern in enumerate(patterns):
+        runs = _literal_runs(pattern[3])
+        if not runs:
+            unanchored.append(pattern_id)
+            continue
+        anchor = max(runs, key=len)[:MAX_ANCHOR]
+        kmers.setdefault(len(anchor), {}).setdefault(anchor, [])\
+             .append(pattern_id)
+    return dict(patterns=patterns, kmers=kmers, unanchored=unanchored)
+
+
+def load_scanner(dat_file=None):
+    """ Return scanner (see build_scanner) over ProSite pattern index, \
+        built once per process """
+    if dat_file is None: dat_file = PROSITE_DAT
+    if dat_file not in _SCANNER:
+        _SCANNER[dat_file] = build_scanner(load_patterns(dat_file))
+    return _SCANNER[dat_file]
+
+
+def scan_sequences(sequences, scanner=None):
+    """ Find ProSite patterns in batch of sequences.
+        Return, for each sequence, list of (pattern, [(start, end), ...]) \
+        for every pattern found, in prosite.dat order """
+    if scanner is None: scanner = load_scanner()
+    patterns = scanner['patterns']
+    results = []
+    for sequence in sequences:
+        candidates = set(scanner['unanchored'])
+        for k, index in scanner['kmers'].items():
+            seq_kmers = {sequence[i:i+k] for i in range(len(sequence)-k+1)}
+            for kmer in seq_kmers.intersection(index):
+                candidates.update(index[kmer])
+        hits = []
+        for pattern_id in sorted(candidates):
+            pattern = patterns[pattern_id]
+            locations = [match.span()
+                         for match in pattern[4].finditer(sequence)]
+            if locations: hits.append((pattern, locations))
+        results.append(hits)
+    return results
+
+
+def dat_parser(sequence,
+               fields=["name", "accession", "description", "pattern"],
+               scanner=None):
+    """ Finds domain hits from prosite.dat in input sequence """
+    return [list(pattern[:4])
+            for pattern, dummy_locations
+            in scan_sequences([sequence], scanner)[0]]
+
+
+def _build_doc_index(doc_file):
+    """ Return {accession: (offset, length)} in bytes \
+        of every record in prosite.doc """
+    offsets = {}
+    start = None
+    offset = 0
+    with open(doc_file, 'rb') as handle:
+        for line in handle:
+            if line.startswith(b'{PDOC'):
+                start = offset
+                accession = line.rstrip()[1:-1].decode()
+            elif line.startswith(b'{END}') and start is not None:
+                offsets[accession] = (start, offset + len(line) - start)
+                start = None
+            offset += len(line)
+    return offsets
+
+
+def load_doc(doc_file=None):
+    """ Return (offset index, mmap) of prosite.doc, \
+        loaded once per process """
+    if doc_file is None: doc_file = PROSITE_DOC
+    if doc_file not in _DOC_INDEX:
+        offsets = _load_index(doc_file, doc_file+'.idx', _build_doc_index)
+        with open(doc_file, 'rb') as handle:
+            # mmap of an empty file is not allowed
+            if os.fstat(handle.fileno()).st_size:
+                doc = mmap.mmap(handle.fileno(), 0, access=mmap.ACCESS_READ)
+            else: doc = b''
+        _DOC_INDEX[doc_file] = (offsets, doc)
+    return _DOC_INDEX[doc_file]
+
+
+def doc_parser(accession, doc_file=None):
+    """ Returns information on domain with input accession number """
+    if doc_file is None: doc_file = PROSITE_DOC
+    key = (doc_file, accession)
+    if key not in _DOC_TEXT:
+        offsets, doc = load_doc(doc_file)
+        if accession not in offsets: return None
+        offset, length = offsets[accession]
+        record = Prodoc.read(io.StringIO(doc[offset:offset+length].decode(),
+                                         newline=None))
+        _DOC_TEXT[key] = record.text
+    return _DOC_TEXT[key]
 
 
 def store_domain_info(input_sequence, output_filename,
                       fields=['name', 'accession', 'description', 'pattern'],
-                      location=False):
+                      location=False, scanner=None, hits=None):
     """ Given an input protein sequence, \
         find ProSite domains and store in output_filename.
+        Hits already found with scan_sequences can be provided.
         Return domains found """
+    if hits is None: hits = scan_sequences([input_sequence], scanner)[0]
     output_file = open(output_filename, 'w')
-    domains = dat_parser(input_sequence, fields=fields)
+    domains = [list(pattern[:4]) for pattern, dummy_locations in hits]
     located_domains = []
     output_file.write(str(len(domains))+' domains found.\n\n\n')
-    for domain in domains:
+    for domain, (dummy_pattern, locations) in zip(domains, hits):
         if location:
-            matches = re.finditer(domain[3], input_sequence)
-            for match in matches:
+            for start, end in locations:
                 located_domains.append(domain
-                                       + [match.start(), match.end(),
-                                       match.start()
-                                       + (match.end() - match.start())/2])
+                                       + [start, end,
+                                          start + (end - start)/2])
         output_file.writelines([str(field)+'\n' for field in domain]+['\n'])
         text = doc_parser(domain[1])
         output_file.write(text + '\n')
@@ -73,44 +308,192 @@ def store_domain_info(input_sequence, output_filename,
     else: return domains
 
 
-def extract_domains(input_fasta, output_dir, summary=True):
-    """ Given a FASTA file, extract domains of each sequence, \
-        store in different files under same directory.
-        Create summary file if requested """
-    seqids = []
-    columns = ['name', 'accession', 'description',
-               'pattern', 'start', 'end', 'midpoint']
-    domains = [ [] for col in columns ]
+def _read_records(input_fasta):
+    """ Return list of (id, sequence) in FASTA file """
     with open(input_fasta, 'r') as fasta:
-        for title, sequence in SimpleFastaParser(fasta):
-            seqid = title.split(None, 1)[0]
-            seq_domains = store_domain_info(
-                                            input_sequence=sequence,
-                                            output_filename=output_dir
-                                                            .rstrip('/')
-                                                            +'/'+seqid
-                                                            +'_dominfo.txt',
-                                            fields=columns[:4], location=True)
-            for domain in seq_domains:
-                for idx in range(len(domains)):
-                    domains[idx].append(domain[idx])
-            seqids.extend([seqid for dummy in range(len(seq_domains))])
+        return [(title.split(None, 1)[0], sequence)
+                for title, sequence in SimpleFastaParser(fasta)]
+
+
+def _hit_records(data):
+    """ Return list of (id, sequence) of blast hits of a single query \
+        (dataframe) followed by query, as written in unaligned.fasta \
+        (see fh.hits2fasta) """
+    return list(zip(data.sseqid, data.sseq)) \
+           + [(data.qseqid.iloc[0], data.qseq.iloc[0])]
+
+
+def _open_cache(cache_file):
+    """ Open (and create if needed) domain cache database """
+    connection = sqlite3.connect(cache_file, timeout=60)
+    connection.execute('CREATE TABLE IF NOT EXISTS domains '
+                       '(key TEXT PRIMARY KEY, hits TEXT, last_used REAL)')
+    return connection
+
+
+def _cache_lookup(connection, keys):
+    """ Return {key: hits} for keys found in domain cache \
+        and mark them as recently used """
+    found = {}
+    keys = list(keys)
+    for idx in range(0, len(keys), 500):
+        chunk = keys[idx:idx+500]
+        rows = connection.execute('SELECT key, hits FROM domains '
+                                  'WHERE key IN ({})'
+                                  .format(','.join('?'*len(chunk))), chunk)
+        for key, hits in rows:
+            found[key] = [(tuple(pattern), [tuple(span) for span in spans])
+                          for pattern, spans in json.loads(hits)]
+    now = time.time()
+    with connection:
+        connection.executemany('UPDATE domains SET last_used = ? '
+                               'WHERE key = ?', [(now, key) for key in found])
+    return found
+
+
+def _cache_store(connection, found, max_entries):
+    """ Store {key: hits} in domain cache, \
+        evicting least recently used entries above max_entries """
+    now = time.time()
+    with connection:
+        connection.executemany('INSERT OR REPLACE INTO domains '
+                               'VALUES (?, ?, ?)',
+                               [(key, json.dumps(hits), now)
+                                for key, hits in found.items()])
+        excess = connection.execute('SELECT COUNT(*) FROM domains')\
+                           .fetchone()[0] - max_entries
+        if excess > 0:
+            connection.execute('DELETE FROM domains WHERE key IN '
+                               '(SELECT key FROM domains '
+                               'ORDER BY last_used LIMIT ?)', (excess,))
+
+
+def _scan_batch(sequences, scanner=None):
+    """ scan_sequences returning only picklable pattern fields """
+    return [[(pattern[:4], spans) for pattern, spans in hits]
+            for hits in scan_sequences(sequences, scanner)]
+
+
+def _domain_hits(sequences, scanner=None, use_cache=True, pool=None):
+    """ Find ProSite patterns (see scan_sequences) in every \
+        distinct sequence, looking them up first in domain cache.
+        Return {sequence: hits}, number of sequences found in cache \
+        and number of distinct sequences """
+    release = prosite_release()
+    keys = {}
+    for sequence in sequences:
+        keys.setdefault(hashlib.sha1((release+':'+sequence).encode())
+                               .hexdigest(), sequence)
+    found = {}
+    if use_cache:
+        connection = _open_cache(DOMAIN_CACHE)
+        found = _cache_lookup(connection, keys)
+    cache_hits = len(found)
+    missing = [key for key in keys if key not in found]
+    batches = [missing[idx:idx+BATCH_SIZE]
+               for idx in range(0, len(missing), BATCH_SIZE)]
+    seq_batches = [[keys[key] for key in batch] for batch in batches]
+    if pool: results = pool.map(_scan_batch, seq_batches)
+    else: results = (_scan_batch(batch, scanner) for batch in seq_batches)
+    scanned = {}
+    for batch, batch_hits in zip(batches, results):
+        scanned.update(zip(batch, batch_hits))
+    if use_cache:
+        _cache_store(connection, scanned, DOMAIN_CACHE_SIZE)
+        connection.close()
+    found.update(scanned)
+    return ({keys[key]: hits for key, hits in found.items()},
+            cache_hits, len(keys))
+
+
+def _init_worker(dat_file, doc_file):
+    """ Load ProSite pattern set once per worker process """
+    global PROSITE_DAT, PROSITE_DOC
+    PROSITE_DAT, PROSITE_DOC = dat_file, doc_file
+    load_scanner()
+
+
+def _write_domains(records, seqs_hits, output_dir):
+    """ Store domain info of every (id, sequence) in records, \
+        given its hits, and create _domains.tsv summary """
+    ids = []
+    domains = [ [] for col in DOMAIN_COLUMNS ]
+    for (seqid, sequence), hits in zip(records, seqs_hits):
+        seq_domains = store_domain_info(
+                                        input_sequence=sequence,
+                                        output_filename=output_dir
+                                                        .rstrip('/')
+                                                        +'/'+seqid
+                                                        +'_dominfo.txt',
+                                        fields=DOMAIN_COLUMNS[:4],
+                                        location=True, hits=hits)
+        for domain in seq_domains:
+            for idx in range(len(domains)):
+                domains[idx].append(domain[idx])
+        ids.extend([seqid for dummy in range(len(seq_domains))])
     df = pd.DataFrame()
-    df['id'] = pd.Series(seqids, name='id')
+    df['id'] = pd.Series(ids, name='id')
     for idx in range(len(domains)):
-        df[columns[idx]] = pd.Series(domains[idx], name=columns[idx])
+        df[DOMAIN_COLUMNS[idx]] = pd.Series(domains[idx],
+                                            name=DOMAIN_COLUMNS[idx])
     df.sort_values(by=['id', 'name', 'start'], ascending=[0,0,1], inplace=True)
     df.to_csv(output_dir.rstrip('/')+'/'+'_domains.tsv', index=False, sep='\t')
 
 
+def extract_domains(input_fasta, output_dir, summary=True, scanner=None,
+                    use_cache=True):
+    """ Given a FASTA file, extract domains of each sequence, \
+        store in different files under same directory.
+        Create summary file if requested.
+        Return number of sequences found in domain cache \
+        and number of distinct sequences looked up """
+    records = _read_records(input_fasta)
+    hits, cache_hits, lookups = _domain_hits(
+                                   [sequence for dummy_id, sequence in records],
+                                   scanner=scanner, use_cache=use_cache)
+    _write_domains(records, [hits[sequence] for dummy_id, sequence in records],
+                   output_dir)
+    return cache_hits, lookups
+
 
-def find_domains(blast_output, output_dir, summary=True):
-    """ For each query in blast_output.tsv, \
-        extract domains of every sequence in unaligned.fasta """
-    df = pd.read_csv(blast_output, delimiter='\t')
-    for qid in pd.unique(df.qseqid):
+def find_domains(blast_output, output_dir, summary=True, workers=1,
+                 use_cache=True):
+    """ For each query in blast_output (tsv file or table in memory, \
+        see fh.read_blast), extract domains of every hit sequence \
+        and of the query (the sequences in unaligned.fasta).
+        Every distinct sequence is scanned once (unless already \
+        in domain cache); with several workers, sequence batches \
+        and queries are handled in a process pool.
+        Return number of queries and of distinct sequences """
+    df = fh.read_blast(blast_output)
+    queries = []
+    for qid, data in df.groupby('qseqid', sort=False):
         query_dir = output_dir.rstrip('/')+'/'+qid+'/'
         os.makedirs(query_dir+'domains/', exist_ok=True)
-        sseqs_file = query_dir+'/'+'unaligned.fasta'
-        extract_domains(sseqs_file, query_dir+'domains/', summary=summary)
-    return
+        queries.append((query_dir+'domains/', _hit_records(data)))
+    pool = None
+    if workers > 1:
+        pool = ProcessPoolExecutor(max_workers=workers,
+                                   initializer=_init_worker,
+                                   initargs=(PROSITE_DAT, PROSITE_DOC))
+    try:
+        hits, cache_hits, lookups = _domain_hits(
+                                       [sequence for dummy_dir, records
+                                        in queries
+                                        for dummy_id, sequence in records],
+                                       use_cache=use_cache, pool=pool)
+        jobs = [(records,
+                 [hits[sequence] for dummy_id, sequence in records],
+                 domains_dir)
+                for domains_dir, records in queries]
+        if pool:
+            for future in [pool.submit(_write_domains, *job) for job in jobs]:
+                future.result()
+        else:
+            for job in jobs: _write_domains(*job)
+    finally:
+        if pool: pool.shutdown()
+    if use_cache:
+        print('{} of {} distinct sequences found in domain cache'
+              .format(cache_hits, lookups))
+    return len(queries), lookups
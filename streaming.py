@@ -0,0 +1,164 @@
+#!/usr/bin/env python
+import io
+import os
+import threading
+import time
+
+from concurrent.futures import ThreadPoolExecutor
+
+import blast as bl
+# pandas, Bio and the other stage modules are imported when streaming
+# starts (graphication only if graphs are drawn), so that importing this
+# module (e.g. for command line help) is fast
+
+# Default number of queries processed at once in streaming mode
+IN_FLIGHT = 4
+OUTFMT = '6 qseqid sseqid qcovs qstart qend pident evalue'
+
+
+def _process_query(hits, query_seq, subject_multifasta, index, output_dir,
+                   log, tree_backend, use_cache, max_figures, render_pool):
+    """ Run retrieve -> alignment -> tree -> domains (-> plots) chain \
+        of a single query, given its blast hits (dataframe). \
+        Plots are drawn in render_pool (if given, see graph.render_pool).
+        Return hits with sequences, domain cache hits and lookups, \
+        and time (s) spent in every step """
+    import pandas as pd
+    import file_handler as fh
+    import muscle as ms
+    import prosite_parser as proparse
+    qseqid = hits.qseqid.iloc[0]
+    query_dir = output_dir.rstrip('/')+'/'+qseqid+'/'
+    os.makedirs(query_dir+'domains/', exist_ok=True)
+    elapsed = {}
+    time0 = time.time()
+    subject_seqs = fh.fetch_seqs(subject_multifasta, pd.unique(hits.sseqid),
+                                 index=index)
+    data = bl.add_sequences(hits, subject_seqs, [(qseqid, query_seq)])
+    fh.hits2fasta(data, query_dir+'unaligned.fasta', include_query=True)
+    elapsed['retrieve'] = time.time() - time0
+    elapsed['alignment'], elapsed['tree'] = ms.align_and_build_tree(
+                                                query_dir, log=log,
+                                                backend=tree_backend)
+    time0 = time.time()
+    cache_hits, lookups = proparse.extract_domains(
+                                   input_fasta=query_dir+'unaligned.fasta',
+                                   output_dir=query_dir+'domains/',
+                                   use_cache=use_cache)
+    elapsed['domains'] = time.time() - time0
+    if render_pool is not None:
+        import graphication as graph
+        time0 = time.time()
+        graph.query_blast_plot(data, output_dir, pool=render_pool)
+        graph.query_domain_plot(data, output_dir, max_figures,
+                                pool=render_pool)
+        elapsed['plots'] = time.time() - time0
+    return data, cache_hits, lookups, elapsed
+
+
+def stream_queries(query_fasta, subject_multifasta, database_path,
+                   sequence_type, e_value, output_dir, output_filename,
+                   cov_threshold=0, pident_threshold=0, log='/dev/null',
+                   shards=1, threads=1, in_flight=IN_FLIGHT,
+                   tree_backend='muscle', use_cache=True, graphs=False,
+                   max_figures=None, export_tsv=False, members=None,
+                   dbsize=None, index_cache=None, index_sources=None):
+    """ Streaming alternative to running blast_compute, retrieve_seqs, \
+        align_and_build_trees, find_domains (and plots) one after \
+        the other for all queries: blast output is read as it is \
+        produced (see bl.stream_blast) and the chain of every query \
+        starts as soon as its hits are final, with at most in_flight \
+        queries being processed at once. Hits of deduplicated subjects \
+        are expanded to every member, e-values being computed \
+        for dbsize residues (see bl.dedup_multifasta).
+        Blast output with sequences is stored (as retrieve_seqs, \
+        exported to output_filename.tsv if export_tsv) once all \
+        queries are done.
+        Return blast output with sequences (dataframe), \
+        number of hits read and kept """
+    from Bio.SeqIO.FastaIO import SimpleFastaParser
+    import pandas as pd
+    import file_handler as fh
+    import prosite_parser as proparse
+    with open(query_fasta, 'r') as fasta:
+        query_seqs = [(title.split(None, 1)[0], sequence)
+                      for title, sequence in SimpleFastaParser(fasta)]
+    order = {qseqid: idx for idx, (qseqid, dummy_seq)
+             in enumerate(query_seqs)}
+    query_seqs = dict(query_seqs)
+    fields = OUTFMT.split()[1:]
+    # Loaded once, shared by every query
+    index = fh.index_fasta(subject_multifasta, cache_dir=index_cache,
+                           sources=index_sources)
+    proparse.load_scanner()
+    proparse.load_doc()
+    # Figures of queries in flight drawn in parallel (up to one per core)
+    render_pool = None
+    if graphs:
+        import graphication as graph
+        render_pool = graph.render_pool(max(1, min(in_flight,
+                                                   os.cpu_count() or 1)))
+    slots = threading.BoundedSemaphore(max(1, in_flight))
+    results = {}
+    finished = []
+    n_read = 0
+    n_kept = 0
+
+    def done(qseqid, future):
+        slots.release()
+        finished.append(qseqid)
+        data, dummy_hits, dummy_lookups, elapsed = future.result()
+        print('  [{}/{}] {}: {} hits, {}'.format(
+              len(finished), len(order), qseqid, len(data),
+              ', '.join('{} {:.1f}s'.format(step, seconds)
+                        for step, seconds in elapsed.items())))
+
+    try:
+        with ThreadPoolExecutor(max_workers=max(1, in_flight)) as pool:
+            for qseqid, lines, n_query in bl.stream_blast(
+                                        query_fasta=query_fasta,
+                                        database_path=database_path,
+                                        sequence_type=sequence_type,
+                                        e_value=e_value,
+                                        cov_threshold=cov_threshold,
+                                        pident_threshold=pident_threshold,
+                                        outfmt=OUTFMT, log=log,
+                                        shards=shards, threads=threads,
+                                        members=members,
+                                        dbsize=dbsize):
+                n_read += n_query
+                n_kept += len(lines)
+                if not lines: continue
+                hits = pd.read_csv(io.StringIO(''.join(lines)),
+                                   delimiter='\t', names=fields,
+                                   dtype=fh.BLAST_DTYPES,
+                                   float_precision='round_trip')
+                # Wait for a free slot before starting next query
+                slots.acquire()
+                results[qseqid] = pool.submit(_process_query, hits,
+                                              query_seqs[qseqid],
+                                              subject_multifasta, index,
+                                              output_dir, log, tree_backend,
+                                              use_cache, max_figures,
+                                              render_pool)
+                results[qseqid].add_done_callback(
+                    lambda future, qseqid=qseqid: done(qseqid, future))
+    finally:
+        if render_pool is not None: render_pool.shutdown()
+    print('{} blast hits read, {} kept after filtering'.format(n_read, n_kept))
+    frames = []
+    cache_hits = 0
+    lookups = 0
+    for qseqid in sorted(results, key=lambda qseqid: order[qseqid]):
+        data, query_cache_hits, query_lookups, dummy_elapsed = \
+            results[qseqid].result()
+        frames.append(data)
+        cache_hits += query_cache_hits
+        lookups += query_lookups
+    if frames: merged = pd.concat(frames, ignore_index=True)
+    else: merged = pd.DataFrame(columns=fields+['sseq', 'qseq', 'qseqlen'])
+    fh.write_hits(merged, output_dir, export_tsv, output_filename+'.tsv')
+    if use_cache:
+        print('{} of {} sequences found in domain cache'
+              .format(cache_hits, lookups))
+    return merged, n_read, n_kept
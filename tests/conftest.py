@@ -0,0 +1,8 @@
+""" Modules are imported from repository root (as main.py does), \
+    synthetic data generators from benchmarks/ """
+import os
+import sys
+
+TESTS_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.dirname(TESTS_DIR))
+sys.path.insert(0, os.path.dirname(TESTS_DIR)+'/benchmarks')
@@ -0,0 +1,18 @@
+import pytest
+
+import blast as bl
+
+MEMBERS = {'s1': ['s2', 's3']}
+
+
+@pytest.mark.parametrize('outfmt', ['6 qseqid sseqid pident evalue',
+                                    '6 qseqid pident evalue sseqid'])
+def test_expand_hits(outfmt):
+    fields = outfmt.split()[1:]
+    hits = [dict(qseqid='q1', sseqid=sseqid, pident='90.0', evalue='1e-10')
+            for sseqid in ['s1', 's4']]
+    lines = ['\t'.join(hit[field] for field in fields)+'\n' for hit in hits]
+    expanded = list(bl.expand_hits(lines, MEMBERS, outfmt))
+    assert all(line.endswith('\n') for line in expanded)
+    assert [line.rstrip('\n').split('\t')[fields.index('sseqid')]
+            for line in expanded] == ['s1', 's2', 's3', 's4']
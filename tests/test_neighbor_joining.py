@@ -0,0 +1,82 @@
+import io
+import os
+import shutil
+import subprocess
+
+import pytest
+from Bio import Phylo
+
+import muscle as ms
+import neighbor_joining as nj
+
+DATA_DIR = os.path.dirname(os.path.abspath(__file__))+'/data'
+# Additive 5-taxon example of Saitou & Nei (1987): NJ recovers the tree
+# exactly, so distances between leaves along it equal the matrix
+IDS = ['a', 'b', 'c', 'd', 'e']
+DIST = [[0, 5, 9, 9, 8],
+        [5, 0, 10, 10, 9],
+        [9, 10, 0, 8, 7],
+        [9, 10, 8, 0, 3],
+        [8, 9, 7, 3, 0]]
+# Clades of tests/data/alignment.fasta: two superclades (A, B)
+# of two clades (1, 2) of two sequences (a, b)
+ALIGNMENT_CLADES = [['seqA1a', 'seqA1b'], ['seqA2a', 'seqA2b'],
+                    ['seqB1a', 'seqB1b'], ['seqB2a', 'seqB2b'],
+                    ['seqA1a', 'seqA1b', 'seqA2a', 'seqA2b']]
+
+
+def _muscle_available():
+    """ Whether real MUSCLE is installed (not benchmarks/bin stand-in) """
+    if not shutil.which('muscle'): return False
+    version = subprocess.run(['muscle', '-version'], stdout=subprocess.PIPE,
+                             stderr=subprocess.STDOUT,
+                             universal_newlines=True)
+    return version.returncode == 0 and 'MUSCLE' in version.stdout
+
+
+def _read_tree(filename):
+    with open(filename, 'r') as newick:
+        return Phylo.read(newick, 'newick')
+
+
+def _split(taxa, side):
+    """ Unrooted split of taxa, given as the side without first taxon """
+    side = set(side)
+    if min(taxa) in side: side = set(taxa) - side
+    return frozenset(side)
+
+
+def _splits(tree):
+    """ Non-trivial unrooted splits (topology) of tree """
+    taxa = {terminal.name for terminal in tree.get_terminals()}
+    splits = set()
+    for clade in tree.find_clades():
+        side = {terminal.name for terminal in clade.get_terminals()}
+        if 1 < len(side) < len(taxa) - 1: splits.add(_split(taxa, side))
+    return splits
+
+
+def test_neighbor_joining_known_example():
+    tree = Phylo.read(io.StringIO(nj.neighbor_joining(IDS, DIST)), 'newick')
+    assert _splits(tree) == {_split(IDS, 'ab'), _split(IDS, 'de')}
+    for idx, taxon in enumerate(IDS):
+        for jdx in range(idx+1, len(IDS)):
+            assert tree.distance(taxon, IDS[jdx]) \
+                   == pytest.approx(DIST[idx][jdx], abs=1e-4)
+
+
+def test_alignment_tree_topology(tmp_path):
+    nj.compute_tree(DATA_DIR+'/alignment.fasta', str(tmp_path/'NJ.phy'))
+    tree = _read_tree(str(tmp_path/'NJ.phy'))
+    taxa = [name for clade in ALIGNMENT_CLADES[:4] for name in clade]
+    assert _splits(tree) == {_split(taxa, clade)
+                             for clade in ALIGNMENT_CLADES}
+
+
+@pytest.mark.skipif(not _muscle_available(), reason='MUSCLE not installed')
+def test_alignment_tree_matches_muscle(tmp_path):
+    for backend in ['muscle', 'numpy']:
+        ms.compute_NJtree(DATA_DIR+'/alignment.fasta',
+                          str(tmp_path/(backend+'.phy')), backend=backend)
+    assert _splits(_read_tree(str(tmp_path/'numpy.phy'))) \
+           == _splits(_read_tree(str(tmp_path/'muscle.phy')))
@@ -0,0 +1,96 @@
+import os
+import random
+import re
+import shutil
+
+import pandas as pd
+import pytest
+
+import generate as gen
+import prosite_parser as proparse
+
+DATA_DIR = os.path.dirname(os.path.abspath(__file__))+'/data'
+# Matches of tests/data/prosite.dat patterns planted in random proteins
+MOTIFS = ['NGTA', 'RKAS', 'SAK', 'SAAD', 'GAAAAS', 'AGKR', 'AAAAAAVVAAC',
+          'RGD', 'AAAAAGKS', 'CAACAAALAAAAAAAAHAAAH',
+          'LAAAAAALAAAAAALAAAAAAL', 'KKAKK', 'KKAKKK']
+
+
+def _proteins(n_proteins, seed=0):
+    """ Random proteins with planted motifs, some starting with \
+        (N-terminal) methionine-lysine or ending with KDEL (C-terminal) """
+    rng = random.Random(seed)
+    proteins = []
+    for dummy in range(n_proteins):
+        sequence = gen.random_protein(rng, 40, 200)
+        for motif in rng.sample(MOTIFS, 3):
+            idx = rng.randint(0, len(sequence))
+            sequence = sequence[:idx] + motif + sequence[idx:]
+        if rng.random() < 0.3: sequence = 'MAK' + sequence[1:]
+        if rng.random() < 0.3: sequence += 'KDEL'
+        proteins.append(sequence)
+    return proteins
+
+
+@pytest.fixture
+def prosite(tmp_path, monkeypatch):
+    """ Copy of tests/data ProSite files (their indexes are stored \
+        beside them), used as default ProSite files """
+    for filename in ['prosite.dat', 'prosite.doc']:
+        shutil.copy(DATA_DIR+'/'+filename, str(tmp_path))
+    monkeypatch.setattr(proparse, 'PROSITE_DAT', str(tmp_path/'prosite.dat'))
+    monkeypatch.setattr(proparse, 'PROSITE_DOC', str(tmp_path/'prosite.doc'))
+    return str(tmp_path/'prosite.dat')
+
+
+@pytest.mark.parametrize('source', ['fixture', 'synthetic'])
+def test_scan_sequences_matches_naive_search(prosite, tmp_path, source):
+    if source == 'synthetic':
+        gen.write_prosite(str(tmp_path/'synthetic'), 300, seed=1)
+        dat_file = str(tmp_path/'synthetic/prosite.dat')
+    else: dat_file = prosite
+    patterns = proparse.load_patterns(dat_file)
+    sequences = _proteins(100)
+    results = proparse.scan_sequences(sequences,
+                                      proparse.build_scanner(patterns))
+    # Every pattern searched in every sequence
+    expected = [[(pattern[:4], [match.span() for match
+                                in re.finditer(pattern[3], sequence)])
+                 for pattern in patterns
+                 if re.search(pattern[3], sequence)]
+                for sequence in sequences]
+    assert [[(pattern[:4], locations) for pattern, locations in hits]
+            for hits in results] == expected
+    assert sum(len(hits) for hits in results) > len(sequences)
+
+
+def test_find_domains_parallel_output_identical(prosite, tmp_path):
+    proteins = _proteins(60, seed=2)
+    rng = random.Random(3)
+    rows = []
+    for query in range(4):
+        # Queries share some subjects
+        for subject in rng.sample(range(len(proteins)), 20):
+            rows.append(dict(qseqid='QUERY{}'.format(query),
+                             sseqid='SUBJECT{}'.format(subject),
+                             sseq=proteins[subject],
+                             qseq=proteins[query]))
+    blast = pd.DataFrame(rows)
+    outputs = {}
+    for workers in [1, 3]:
+        output_dir = str(tmp_path/'workers{}'.format(workers))
+        os.mkdir(output_dir)
+        proparse.find_domains(blast, output_dir, workers=workers,
+                              use_cache=False)
+        outputs[workers] = {}
+        for root, dummy_dirs, files in os.walk(output_dir):
+            for filename in files:
+                with open(root+'/'+filename, 'rb') as handle:
+                    outputs[workers][os.path.relpath(root+'/'+filename,
+                                                     output_dir)] \
+                        = handle.read()
+    assert sorted(outputs[1]) == sorted(outputs[3])
+    assert len([name for name in outputs[1]
+                if name.endswith('_domains.tsv')]) == 4
+    for name, content in outputs[1].items():
+        assert outputs[3][name] == content, name